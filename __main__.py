@@ -2,18 +2,44 @@ from lazyuselessbot.bot import CustomBot
 from menu.simple_menu import SimpleMenu
 from music.downloader import MusicDownloader
 from music.database import MusicDatabase
+from music.workers import DownloadPool
+from music.shards import ShardedDownloadPool
+from lazyuselessbot.logs import JsonFormatter, LogQueueHandler
+from metrics.exporter import MetricsExporter
+from metrics.registry import registry
 
 import logging
+import logging.handlers
 import threading
+import contextlib
+import queue
 import locale
 import json
+from time import monotonic
+from concurrent.futures import ThreadPoolExecutor
 
 import asyncio
 
 
 class Controller():
     def __init__(self):
-        pass
+        # startup step → seconds, reported once the bot is running
+        self.startup_times: dict[str, float] = {}
+        self.started = monotonic()
+
+    @contextlib.contextmanager
+    def timed(self, step: str):
+        start = monotonic()
+        try:
+            yield
+        finally:
+            self.startup_times[step] = monotonic() - start
+
+    def report_startup(self):
+        total = monotonic() - self.started
+        registry.gauge('startup_seconds', 'Seconds from process start until the bot thread started').set(round(total, 3))
+        steps = ', '.join(f'{step} {seconds:.2f}' for step, seconds in self.startup_times.items())
+        self.logger.info(f'Started in {total:.2f}sec: {steps}')
 
     def configure_root_logger(self):
         """ Optional """
@@ -27,21 +53,42 @@ class Controller():
 
         console_handler = logging.StreamHandler()
         console_handler.setFormatter(formatter)
-        self.logger.addHandler(console_handler)
 
         # f'./logs/{datetime.now().strftime("file_%d_%m_%Y_%H_%M.log")}'
-        file_handler = logging.FileHandler(filename=f'./logs/file.log',
-                                           mode='a', encoding='utf-8')
-        file_handler.setFormatter(formatter)
-        self.logger.addHandler(file_handler)
+        file_handler = logging.handlers.RotatingFileHandler(filename=self.log_file,
+                                                            maxBytes=self.log_max_bytes,
+                                                            backupCount=self.log_backup_count,
+                                                            mode='a', encoding='utf-8')
+        file_handler.setFormatter(JsonFormatter(datefmt='%Y-%m-%dT%H:%M:%S%z'))
+
+        # handlers write from the listener thread, callers only enqueue the record
+        log_queue = queue.SimpleQueue()
+        self.logger.addHandler(LogQueueHandler(log_queue))
+        self.log_listener = logging.handlers.QueueListener(log_queue, console_handler, file_handler,
+                                                           respect_handler_level=True)
+        self.log_listener.start()
 
     def configure_bot(self):
-        self.bot = CustomBot(self.music_database)
+        self.bot = CustomBot(self.music_database, self.download_pool)
         self.bot.disable_httpx_logger()
         self.bot.load_settings(self.bot_settings_filename)
         self.bot.connect()
         self.bot.setup_handlers()
 
+    def configure_database_and_bot(self):
+        """ The database connects and migrates while the bot application is built """
+        self.music_database = MusicDatabase(self.music_downloader)
+        with ThreadPoolExecutor(max_workers=2, thread_name_prefix='startup') as executor:
+            database = executor.submit(self.timed_step, 'database', self.configure_music_database)
+            bot = executor.submit(self.timed_step, 'bot', self.configure_bot)
+            database.result()
+            bot.result()
+
+    def timed_step(self, step: str, configure):
+        with self.timed(step):
+            configure()
+
+    def start_bot(self):
         loop = asyncio.new_event_loop()
         self.bot_thread = threading.Thread(target=self.bot.start,
                                            args=(loop, ))
@@ -53,12 +100,27 @@ class Controller():
 
     def configure_music_downloader(self):
         self.music_downloader: MusicDownloader = MusicDownloader()
+        self.music_downloader.load_settings(self.music_settings_filename)
 
     def configure_music_database(self):
-        self.music_database = MusicDatabase(self.music_downloader)
         self.music_database.load_settings(self.music_settings_filename)
         self.music_database.connect()
         self.music_database.create_table_if_no_exist()
+        self.music_database.warm_cache()
+        self.music_database.load_storage()
+
+    def configure_download_pool(self):
+        if self.worker_processes:
+            self.download_pool = ShardedDownloadPool(self.worker_processes, self.music_settings_filename)
+        else:
+            self.download_pool = DownloadPool()
+        self.download_pool.load_settings(self.music_settings_filename)
+        self.download_pool.start()
+
+    def configure_metrics(self):
+        self.metrics_exporter = MetricsExporter(registry)
+        self.metrics_exporter.load_settings(self.metrics_settings)
+        self.metrics_exporter.start()
 
     def display_menu(self):
         self.menu.display_menu()
@@ -67,6 +129,11 @@ class Controller():
         self.logger.info("Waiting for bot thread to shutdown..")
         self.bot_thread.join()
         self.logger.info("Bot Thread Down.")
+        self.download_pool.shutdown()
+        self.music_downloader.shutdown()
+        self.music_database.disconnect()
+        self.metrics_exporter.stop()
+        self.log_listener.stop()
 
     def load_settings(self, filename: str):
         with open(filename, 'r', encoding='utf-8') as settings:
@@ -76,15 +143,31 @@ class Controller():
         self.music_settings_filename = settings.get('music_settings')
         self.music_database_filename = settings.get('music_database')
 
+        self.log_file = settings.get('log_file', './logs/file.log')
+        self.log_max_bytes = settings.get('log_max_bytes', 10 * 1024 * 1024)
+        self.log_backup_count = settings.get('log_backup_count', 5)
+        # {"listen": "127.0.0.1", "port": 9100, "json_file": "./logs/metrics.json", "json_interval": 60}
+        self.metrics_settings = settings.get('metrics', {})
+        # processes running download jobs, 0 runs them on threads of this process
+        self.worker_processes = settings.get('worker_processes', 0)
+
 
 def main():
     controller = Controller()
-    controller.load_settings(settings)
-    controller.configure_root_logger()
-    controller.configure_music_downloader()
-    controller.configure_music_database()
-    controller.configure_bot()
+    with controller.timed('settings'):
+        controller.load_settings(settings)
+    with controller.timed('logger'):
+        controller.configure_root_logger()
+    with controller.timed('metrics'):
+        controller.configure_metrics()
+    with controller.timed('downloader'):
+        controller.configure_music_downloader()
+        controller.configure_download_pool()
+    controller.configure_database_and_bot()
+    controller.start_bot()
     controller.configure_simple_menu()
+    controller.report_startup()
+    controller.music_downloader.preload()
     controller.display_menu()
     controller.wait_for_threads_to_shutdown()
 
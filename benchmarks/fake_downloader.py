@@ -0,0 +1,50 @@
+import threading
+from time import sleep
+
+from music.downloader import MusicDownloader
+
+# one MPEG-1 layer III frame: 128 kbps, 44.1 kHz, stereo, 417 bytes of silence
+MP3_FRAME = b'\xff\xfb\x90\x00' + bytes(413)
+FRAMES_PER_SECOND = 44100 / 1152
+
+
+class FakeDownloader(MusicDownloader):
+    """ MusicDownloader producing synthetic mp3s instead of talking to youtube.
+
+    bench:playlist:<n>:<prefix> expands to n entries, any other url is one song.
+    """
+
+    def __init__(self, download_delay: float = 0.0, duration: int = 10):
+        super().__init__()
+        self.download_delay = download_delay
+        self.duration = duration
+        self.lock = threading.Lock()
+        self.downloads = 0
+
+    def info(self, youtube_id: str) -> dict:
+        return {
+            'id': youtube_id,
+            'webpage_url': f'https://youtu.be/{youtube_id}',
+            'duration': self.duration,
+            'artist': 'Bench',
+            'track': youtube_id,
+        }
+
+    def retrive_entries(self, url: str) -> list[dict]:
+        if url.startswith('bench:playlist:'):
+            _, _, count, prefix = url.split(':')
+            return [{'_type': 'url', 'id': f'{prefix}{index}', 'url': f'https://youtu.be/{prefix}{index}',
+                     'duration': self.duration} for index in range(int(count))]
+        return [self.info(url.rsplit('/', 1)[-1])]
+
+    def resolve_info(self, entry: dict) -> dict:
+        return self.info(entry.get('id')) if entry.get('_type') == 'url' else entry
+
+    def song(self, info: dict, filename: str) -> str:
+        self.admit(info)
+        sleep(self.download_delay)
+        with open(f'{filename}.mp3', 'wb') as audio:
+            audio.write(MP3_FRAME * int(self.duration * FRAMES_PER_SECOND))
+        with self.lock:
+            self.downloads += 1
+        return f'{filename}.mp3'
@@ -0,0 +1,72 @@
+import json
+import threading
+from time import time, sleep
+from collections import Counter
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+BOT_USER = {'id': 1, 'is_bot': True, 'first_name': 'bench', 'username': 'bench_bot'}
+CHAT = {'id': 1, 'type': 'private'}
+
+
+class FakeTelegram():
+    """ Stand-in Bot API server answering every method the bot uses with canned results """
+
+    def __init__(self, port: int = 0, latency: float = 0.0):
+        self.latency = latency
+        self.calls = Counter()
+        self.lock = threading.Lock()
+        self.message_id = 0
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_POST(self):
+                # drain the body, uploads included
+                self.rfile.read(int(self.headers.get('Content-Length', 0)))
+                method = self.path.rsplit('/', 1)[-1]
+                body = json.dumps({'ok': True, 'result': fake.result(method)}).encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', f'{len(body)}')
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', port), Handler)
+        self.thread = threading.Thread(target=self.server.serve_forever, name='fake-telegram', daemon=True)
+
+    @property
+    def base_url(self) -> str:
+        return f'http://127.0.0.1:{self.server.server_address[1]}/bot'
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def message(self, **kwargs) -> dict:
+        with self.lock:
+            self.message_id += 1
+            message_id = self.message_id
+        return {'message_id': message_id, 'date': int(time()), 'chat': CHAT, 'from': BOT_USER, **kwargs}
+
+    def result(self, method: str):
+        with self.lock:
+            self.calls[method] += 1
+        if self.latency:
+            sleep(self.latency)
+        if method == 'getMe':
+            return BOT_USER
+        if method == 'sendMessage':
+            return self.message(text='')
+        if method == 'sendAudio':
+            message = self.message()
+            file_id = f'audio{message["message_id"]}'
+            message['audio'] = {'file_id': file_id, 'file_unique_id': file_id, 'duration': 10}
+            return message
+        return True
@@ -0,0 +1,241 @@
+""" Throughput benchmark against a fake Bot API server and a fake youtube.
+
+python -m benchmarks.run [--scenario single playlist concurrent cached library] [--no-rate-limit]
+"""
+import os
+import json
+import random
+import shutil
+import asyncio
+import logging
+import resource
+import argparse
+import tempfile
+from time import time, monotonic
+
+from telegram import Update
+
+from lazyuselessbot.bot import CustomBot
+from music.cache import SongCache
+from music.database import MusicDatabase, chunks
+from music.workers import DownloadPool
+from benchmarks.fake_telegram import FakeTelegram
+from benchmarks.fake_downloader import FakeDownloader
+
+SCENARIOS = ('single', 'playlist', 'concurrent', 'cached', 'library')
+
+
+def percentile(values: list[float], q: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, round(q * (len(values) - 1)))]
+
+
+def peak_rss_mb() -> float:
+    # kilobytes on linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+class Benchmark():
+    def __init__(self, args: argparse.Namespace):
+        self.args = args
+        self.directory = tempfile.mkdtemp(prefix='lazyuselessbot-bench-')
+        self.update_id = 0
+        # exceptions raised by handlers, a scenario with any of them failed
+        self.errors: list[BaseException] = []
+
+    def write_settings(self, name: str, settings: dict) -> str:
+        filename = os.path.join(self.directory, name)
+        with open(filename, 'w') as settings_file:
+            json.dump(settings, settings_file)
+        return filename
+
+    async def setup(self):
+        self.telegram = FakeTelegram(latency=self.args.api_latency)
+        self.telegram.start()
+
+        for folder in ('songs', 'thumbnails', 'music'):
+            os.makedirs(os.path.join(self.directory, folder))
+        music_settings = self.write_settings('music.json', {
+            'songs_path': os.path.join(self.directory, 'songs'),
+            'thumbnails_path': os.path.join(self.directory, 'thumbnails'),
+            'music_database': f'sqlite:///{os.path.join(self.directory, "music.db")}',
+            'download_workers': self.args.workers,
+        })
+        self.downloader = FakeDownloader(self.args.download_delay)
+        self.database = MusicDatabase(self.downloader)
+        self.database.load_settings(music_settings)
+        self.database.connect()
+        self.database.create_table_if_no_exist()
+
+        self.pool = DownloadPool()
+        self.pool.load_settings(music_settings)
+        self.pool.start()
+
+        bot_settings = {
+            'token': '1:bench',
+            'base_url': self.telegram.base_url,
+            'music_path': os.path.join(self.directory, 'music', ''),
+            'update_log_sample_rate': 0,
+        }
+        if self.args.no_rate_limit:
+            bot_settings['rate_limits'] = {'global_rate': 10 ** 6, 'chat_rate': 10 ** 6, 'group_rate': 10 ** 8}
+        self.bot = CustomBot(self.database, self.pool)
+        self.bot.load_settings(self.write_settings('bot.json', bot_settings))
+        self.bot.connect()
+        self.bot.setup_handlers()
+        self.bot.application.add_error_handler(self.handler_error)
+        await self.bot.application.initialize()
+
+    async def teardown(self):
+        await self.bot.application.shutdown()
+        await self.database.disconnect_async()
+        self.pool.shutdown()
+        self.downloader.shutdown()
+        self.database.disconnect()
+        self.telegram.stop()
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    async def handler_error(self, update: object, context):
+        self.errors.append(context.error)
+
+    def expected_audio(self, scenario: str) -> int:
+        """ sendAudio calls a scenario makes when every track gets through """
+        return {
+            'single': 1,
+            'playlist': self.args.playlist,
+            'concurrent': self.args.chats,
+            # warm-up run plus the measured one
+            'cached': 2 * self.args.playlist,
+            'library': 1,
+        }[scenario]
+
+    def check(self, scenario: str, api_calls: dict):
+        errors, self.errors = self.errors, []
+        if errors:
+            raise RuntimeError(f'{scenario}: {len(errors)} handlers raised, first: {errors[0]!r}') from errors[0]
+        if api_calls.get('sendAudio', 0) != self.expected_audio(scenario):
+            raise RuntimeError(f'{scenario}: expected {self.expected_audio(scenario)} sendAudio calls, '
+                               f'got {api_calls.get("sendAudio", 0)}')
+
+    def music_update(self, chat_id: int, url: str) -> Update:
+        self.update_id += 1
+        return Update.de_json({
+            'update_id': self.update_id,
+            'message': {
+                'message_id': self.update_id,
+                'date': int(time()),
+                'chat': {'id': chat_id, 'type': 'private'},
+                'from': {'id': chat_id, 'is_bot': False, 'first_name': 'bench'},
+                'text': f'/music {url}',
+                'entities': [{'type': 'bot_command', 'offset': 0, 'length': len('/music')}],
+            }
+        }, self.bot.bot)
+
+    async def request(self, chat_id: int, url: str) -> float:
+        start = monotonic()
+        await self.bot.application.process_update(self.music_update(chat_id, url))
+        return monotonic() - start
+
+    async def single(self) -> tuple[list[float], int]:
+        return [await self.request(1, 'https://youtu.be/single')], 1
+
+    async def playlist(self) -> tuple[list[float], int]:
+        tracks = self.args.playlist
+        return [await self.request(2, f'bench:playlist:{tracks}:playlist')], tracks
+
+    async def concurrent(self) -> tuple[list[float], int]:
+        chats = self.args.chats
+        latencies = await asyncio.gather(*(self.request(1000 + chat, f'https://youtu.be/chat{chat}')
+                                           for chat in range(chats)))
+        return list(latencies), chats
+
+    async def cached(self) -> tuple[list[float], int]:
+        tracks = self.args.playlist
+        # first run downloads, the measured one only re-sends by telegram_id
+        await self.request(3, f'bench:playlist:{tracks}:cached')
+        return [await self.request(3, f'bench:playlist:{tracks}:cached')], tracks
+
+    async def library(self) -> tuple[list[float], int]:
+        rows = self.args.library_rows
+        for batch in chunks(list(range(rows)), 10000):
+            self.database.insert_songs([{'youtube_id': f'library{index}',
+                                         'filename': f'library{index}.mp3',
+                                         'telegram_id': f'telegram{index}',
+                                         'duration': 10,
+                                         'performer': 'Bench',
+                                         'title': f'library{index}',
+                                         'thumbnail': ''} for index in batch])
+        # cold lookups, nothing of the library is cached yet
+        self.database.cache = SongCache()
+        latencies = []
+        for _ in range(200):
+            ids = [f'library{random.randrange(rows)}' for _ in range(50)]
+            start = monotonic()
+            await asyncio.get_running_loop().run_in_executor(None, self.database.get_audios, ids)
+            latencies.append(monotonic() - start)
+        latencies.append(await self.request(4, f'https://youtu.be/library{rows // 2}'))
+        return latencies, 200 * 50
+
+    async def run(self) -> list[dict]:
+        results = []
+        await self.setup()
+        try:
+            for scenario in self.args.scenario:
+                calls = dict(self.telegram.calls)
+                start = monotonic()
+                latencies, tracks = await getattr(self, scenario)()
+                seconds = monotonic() - start
+                api_calls = {method: count - calls.get(method, 0)
+                             for method, count in self.telegram.calls.items() if count != calls.get(method, 0)}
+                self.check(scenario, api_calls)
+                results.append({
+                    'scenario': scenario,
+                    'requests': len(latencies),
+                    'tracks': tracks,
+                    'seconds': round(seconds, 3),
+                    'tracks_per_sec': round(tracks / seconds, 2) if seconds else 0.0,
+                    'p50': round(percentile(latencies, 0.5), 4),
+                    'p95': round(percentile(latencies, 0.95), 4),
+                    'p99': round(percentile(latencies, 0.99), 4),
+                    'peak_rss_mb': round(peak_rss_mb(), 1),
+                    'api_calls': api_calls,
+                })
+        finally:
+            await self.teardown()
+        return results
+
+
+def print_results(results: list[dict]):
+    print(f'{"scenario":>10} | {"requests":>8} | {"tracks":>6} | {"seconds":>8} | {"tracks/s":>8} | '
+          f'{"p50":>8} | {"p95":>8} | {"p99":>8} | {"rss MB":>7} | api calls')
+    for result in results:
+        print(f'{result["scenario"]:>10} | {result["requests"]:>8} | {result["tracks"]:>6} | {result["seconds"]:>8} | '
+              f'{result["tracks_per_sec"]:>8} | {result["p50"]:>8} | {result["p95"]:>8} | {result["p99"]:>8} | '
+              f'{result["peak_rss_mb"]:>7} | {result["api_calls"]}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark CustomBot against fake Telegram and youtube.')
+    parser.add_argument('--scenario', nargs='+', choices=SCENARIOS, default=list(SCENARIOS))
+    parser.add_argument('--playlist', type=int, default=100, help='tracks in playlist scenarios')
+    parser.add_argument('--chats', type=int, default=50, help='chats in concurrent scenario')
+    parser.add_argument('--library-rows', type=int, default=100000)
+    parser.add_argument('--workers', type=int, default=4, help='download workers')
+    parser.add_argument('--download-delay', type=float, default=0.2, help='simulated seconds per download')
+    parser.add_argument('--api-latency', type=float, default=0.0, help='simulated seconds per Bot API call')
+    parser.add_argument('--no-rate-limit', action='store_true', help='measure the pipeline without flood limits')
+    parser.add_argument('--json', help='also write results to this file')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    results = asyncio.run(Benchmark(args).run())
+    print_results(results)
+    if args.json:
+        with open(args.json, 'w') as results_file:
+            json.dump(results, results_file, indent=4)
+
+
+if __name__ == '__main__':
+    main()
@@ -3,27 +3,51 @@ from telegram.ext import (
     Application,
     CommandHandler,
     MessageHandler,
+    InlineQueryHandler,
     CallbackContext,
 )
-from telegram import Bot, Message, Update
+from telegram import Bot, Message, Update, InlineQueryResultCachedAudio
 from telegram.ext import filters
 from telegram.constants import ChatAction
+from telegram.error import BadRequest
 import logging
-from pprint import pformat
-from time import time
-from shutil import move
+from random import random
 
 from music.database import MusicDatabase
+from music.workers import DownloadPool
+from music.ingest import AudioIngest
+from music.retry import DownloadFailed
+from music.downloader import AudioRejected, video_id
+from music.music import JOB_LISTING
+from lazyuselessbot.rate_limiter import RateLimiter
+from metrics.registry import registry
 
+import os
 import asyncio
+import contextlib
 import json
 
 
 class CustomBot():
-    def __init__(self, music_database: MusicDatabase):
+    def __init__(self, music_database: MusicDatabase, download_pool: DownloadPool):
         self.logger = logging.getLogger(__name__)
+        self.update_logger = logging.getLogger(f'{__name__}.updates')
+        self.update_log_sample_rate = 1.0
         self.music_database = music_database
-        self.last_action = time()
+        self.download_pool = download_pool
+        self.audio_ingest = AudioIngest(music_database)
+        self.rate_limiter = RateLimiter()
+        self.record_batch_size = 10
+        self.search_results = 5
+        # telegram shows at most 50 inline results
+        self.inline_results = 50
+        # youtube_id → telegram_id of uploads in progress or not yet recorded
+        self.uploads: dict[str, asyncio.Future] = {}
+        # /music requests being handled, waited for on shutdown
+        self.requests: set[asyncio.Task] = set()
+        self.draining = False
+        # event loop of the bot thread, set by start
+        self.loop: asyncio.AbstractEventLoop = None
 
     def disable_httpx_logger(self):
         logging.getLogger("httpx").setLevel(logging.WARNING)
@@ -37,9 +61,34 @@ class CustomBot():
         self.owner_group_id: int = settings.get('owner_group_id')
 
         self.music_path = settings.get('music_path')
+        # {"global_rate": 30, "chat_rate": 1, "group_rate": 20}
+        self.rate_limiter = RateLimiter(**settings.get('rate_limits', {}))
+
+        # "polling" or "webhook"
+        self.mode: str = settings.get('mode', 'polling')
+        # {"listen": "0.0.0.0", "port": 8443, "url_path": "bot", "webhook_url": "https://host/bot",
+        #  "secret_token": "...", "cert": null, "key": null}
+        self.webhook: dict = settings.get('webhook', {})
+        # number of updates handled at once, e.g. several /music requests in parallel
+        self.concurrent_updates: int = settings.get('concurrent_updates', 32)
+        # share of incoming updates written to the log, 1.0 logs all of them
+        self.update_log_sample_rate: float = settings.get('update_log_sample_rate', 1.0)
+        # local Bot API server, e.g. "http://127.0.0.1:8081/bot"
+        self.base_url: str = settings.get('base_url')
+        self.base_file_url: str = settings.get('base_file_url')
+        # seconds shutdown waits for requests in progress, the rest resume on next start
+        self.drain_timeout: float = settings.get('drain_timeout', 60)
+        self.max_job_attempts: int = settings.get('max_job_attempts', 3)
 
     def connect(self):
-        self.application: Application = ApplicationBuilder().token(self.token).build()
+        builder = (ApplicationBuilder().token(self.token).
+                   concurrent_updates(self.concurrent_updates).
+                   post_init(self.resume_jobs))
+        if self.base_url:
+            builder = builder.base_url(self.base_url)
+        if self.base_file_url:
+            builder = builder.base_file_url(self.base_file_url)
+        self.application: Application = builder.build()
         self.bot: Bot = self.application.bot
 
     def setup_handlers(self):
@@ -56,6 +105,12 @@ class CustomBot():
         self.application.add_handler(CommandHandler('music', self.music, filters.UpdateType.MESSAGES | filters.UpdateType.CHANNEL_POST),
                                      group=group)
 
+        # search library, as a command and inline
+        self.application.add_handler(CommandHandler('search', self.search),
+                                     group=group)
+        self.application.add_handler(InlineQueryHandler(self.inline_query),
+                                     group=group)
+
         # download income audio
         self.application.add_handler(MessageHandler(filters.AUDIO, self.audio),
                                      group=group)
@@ -63,13 +118,6 @@ class CustomBot():
         # error handler
         self.application.add_error_handler(self.error)
 
-    async def check_send_rate(self):
-        curtime = time()
-        if curtime - self.last_action < 4:
-            print(f'Sleeping for {4 - (curtime - self.last_action)}sec')
-            await asyncio.sleep(4 - (curtime - self.last_action))
-        self.last_action = curtime
-
     async def start_message(self, update: Update, context: CallbackContext):
         kwargs = {
             'chat_id': update.effective_chat.id,
@@ -90,18 +138,24 @@ class CustomBot():
             'chat_id': update.effective_chat.id,
             'text': 'Send me youtube link to retrieve audio from it.\n'
                     '/music <link>\n'
+                    'Find songs already in library.\n'
+                    '/search <performer or title>\n'
                     'Send me audio to share with me your music (◕‿◕✿)'
         }
         await self.send_message(**kwargs)
 
-    async def upload_music(self, song: dict, chat_id):
+    async def upload_music(self, song: dict, chat_id, refetched: bool = False) -> str:
+        """ Send song to chat, return telegram file id if it had to be uploaded.
+
+        A song is downloaded again at most once, `refetched` tells it already was.
+        """
         kwargs = {
             'duration': song.get('duration'),
             'performer': song.get('performer'),
             'title': song.get('title'),
             'caption': f'https://youtu.be/{song.get("youtube_id")}',
-            'thumbnail': open(song.get('thumbnail'), 'rb')
         }
+        # re-sends by telegram_id keep the thumbnail uploaded with the file
         if song.get('telegram_id'):
             message_kwargs = {
                 'chat_id': chat_id,
@@ -112,39 +166,244 @@ class CustomBot():
                 f'Title: {song.get("title")}'
             }
             await self.send_message(**message_kwargs)
+            # requested songs keep their local copy longest, for a refetch to be rare
+            self.music_database.storage.touch(song.get('filename'))
             kwargs.update(audio=song.get('telegram_id'))
+            try:
+                await self.send_audio(chat_id, **kwargs)
+            except BadRequest as err:
+                # telegram no longer knows the file, local copy may be evicted too
+                self.logger.warning(f'Re-send of {song.get("youtube_id")} failed: {err}')
+                if refetched:
+                    raise
+                return await self.refetch(song, chat_id)
+        elif song.get('youtube_id') in self.uploads:
+            # same song is being uploaded for another chat, reuse its telegram id
+            try:
+                kwargs.update(audio=await asyncio.shield(self.uploads[song.get('youtube_id')]))
+            except Exception:
+                return await self.upload_music(song, chat_id, refetched)
             await self.send_audio(chat_id, **kwargs)
+        elif not self.music_database.storage.exists(song.get('filename')):
+            # evicted once another chat recorded its upload, the record has the telegram id by now
+            record = await self.music_database.get_audio_async(song.get('youtube_id'))
+            if record and record.get('telegram_id'):
+                return await self.upload_music(record, chat_id, refetched)
+            if refetched:
+                raise FileNotFoundError(f'No local copy of {song.get("youtube_id")} after download')
+            return await self.refetch(song, chat_id)
         else:
-            with open(song.get('filename'), 'rb') as audio:
-                kwargs.update(audio=audio)
-                audio_message = await self.send_audio(chat_id, **kwargs)
-                self.music_database.update_record(song.get('youtube_id'),
-                                                  audio_message.audio.file_id)
+            upload = asyncio.get_running_loop().create_future()
+            self.uploads[song.get('youtube_id')] = upload
+            try:
+                with contextlib.ExitStack() as files:
+                    kwargs.update(audio=files.enter_context(open(song.get('filename'), 'rb')))
+                    if song.get('thumbnail') and os.path.exists(song.get('thumbnail')):
+                        kwargs.update(thumbnail=files.enter_context(open(song.get('thumbnail'), 'rb')))
+                    audio_message = await self.send_audio(chat_id, **kwargs)
+            except Exception as err:
+                del self.uploads[song.get('youtube_id')]
+                upload.set_exception(err)
+                # nobody may be waiting for it
+                upload.exception()
+                raise
+            upload.set_result(audio_message.audio.file_id)
+            return audio_message.audio.file_id
 
-    async def music_download(self, url: str, chat_id):
-        for song in self.music_database.get_music(url):
-            await self.upload_music(song, chat_id)
+    async def refetch(self, song: dict, chat_id) -> str:
+        song = await self.download_pool.run(chat_id, self.music_database.refetch, song,
+                                            key=song.get('youtube_id'))
+        return await self.upload_music(song, chat_id, refetched=True)
+
+    async def music_download(self, url: str, chat_id, job_id: int):
+        # yt-dlp and ffmpeg run on the download pool, not on the event loop;
+        # every track is uploaded as soon as it is ready
+        youtube_id = video_id(url)
+        if youtube_id and await self.music_database.get_audio_async(youtube_id):
+            # a song already in library is sent without asking youtube anything
+            entries = [{'_type': 'url', 'id': youtube_id, 'url': url}]
+        else:
+            try:
+                entries = await self.download_pool.run(chat_id, self.music_database.list_entries, job_id, url)
+            except DownloadFailed as err:
+                # dead-lettered and its job deleted already, the other links go on
+                await self.send_message(chat_id, text=f'Failed to download\n{err.url}\n{err.reason}')
+                return
+        # library lookups stay in this process, where the song cache is
+        entries = await asyncio.get_running_loop().run_in_executor(
+            None, self.music_database.queue_entries, job_id, chat_id, entries)
+        await self.download_tracks(entries, chat_id)
+
+    async def download_tracks(self, entries: list[dict], chat_id):
+        # telegram ids are written in batches instead of a session per track,
+        # finished are the youtube_ids whose jobs are done
+        uploaded, filenames, finished = {}, [], []
+        # map yields in order, library records carry youtube_id instead of id
+        youtube_ids = iter([entry.get('id') or entry.get('youtube_id') for entry in entries])
+        try:
+            # chats asking for the same video at once share one download
+            async for song in self.download_pool.map(chat_id, self.music_database.get_song, entries,
+                                                     key=lambda entry: entry.get('id'),
+                                                     return_exceptions=True):
+                youtube_id = next(youtube_ids)
+                if isinstance(song, DownloadFailed):
+                    # skip the broken entry, keep going with the rest
+                    await self.send_message(chat_id, text=f'Failed to download\n{song.url}\n{song.reason}')
+                    finished.append(youtube_id)
+                    continue
+                if isinstance(song, AudioRejected):
+                    await self.send_message(chat_id, text=f'Skipped\n{song.url}\n{song.reason}')
+                    finished.append(youtube_id)
+                    continue
+                if isinstance(song, Exception):
+                    raise song
+                telegram_id = await self.upload_music(song, chat_id)
+                if telegram_id:
+                    uploaded[song.get('youtube_id')] = telegram_id
+                    filenames.append(song.get('filename'))
+                finished.append(youtube_id)
+                if len(finished) >= self.record_batch_size:
+                    await self.record_uploads(chat_id, uploaded, filenames, finished)
+                    uploaded, filenames, finished = {}, [], []
+        finally:
+            if finished:
+                await self.record_uploads(chat_id, uploaded, filenames, finished)
+
+    async def record_uploads(self, chat_id, uploaded: dict[str, str], filenames: list[str], finished: list[str]):
+        # a crash before the jobs are deleted re-sends by the recorded telegram id
+        if uploaded:
+            await self.music_database.update_records_async(uploaded)
+        await self.music_database.finish_jobs_async(chat_id, finished)
+        # local copies are no longer needed, may be evicted under disk budget
+        await asyncio.get_running_loop().run_in_executor(None, self.music_database.storage.release, filenames)
+        # from now on the database answers with the telegram id
+        for youtube_id in uploaded:
+            self.uploads.pop(youtube_id, None)
 
     async def music(self, update: Update, context: CallbackContext):
-        # for each individual link
-        for arg in context.args:
-            await self.music_download(arg, update.effective_chat.id)
-        await self.check_send_rate()
+        chat_id = update.effective_chat.id
+        # recorded before any work, a restart resumes what is left
+        jobs = [(await self.music_database.add_job_async(chat_id, arg), arg) for arg in context.args]
+        if self.draining:
+            await self.send_message(chat_id, text='Restarting, your request is queued.')
+            return
+        with self.track():
+            # for each individual link
+            for job_id, url in jobs:
+                with registry.stage('request').time():
+                    await self.music_download(url, chat_id, job_id)
+        await self.rate_limiter.acquire()
         await update.effective_message.delete()
 
+    @contextlib.contextmanager
+    def track(self):
+        task = asyncio.current_task()
+        self.requests.add(task)
+        try:
+            yield
+        finally:
+            self.requests.discard(task)
+
+    async def resume_jobs(self, application: Application):
+        """ Continue the requests the previous run did not finish """
+        jobs = await self.music_database.resume_jobs_async(self.max_job_attempts)
+        chats: dict[int, list[dict]] = {}
+        for job in jobs:
+            chats.setdefault(job.get('chat_id'), []).append(job)
+        for chat_id, chat_jobs in chats.items():
+            asyncio.create_task(self.resume_chat(chat_id, chat_jobs))
+        if jobs:
+            self.logger.info(f'Resuming {len(jobs)} jobs of {len(chats)} chats')
+
+    async def resume_chat(self, chat_id: int, jobs: list[dict]):
+        with self.track():
+            try:
+                # tracks of listed playlists first, downloaded ones are only uploaded
+                youtube_ids = [job.get('youtube_id') for job in jobs if job.get('stage') != JOB_LISTING]
+                if youtube_ids:
+                    entries = await asyncio.get_running_loop().run_in_executor(
+                        None, self.music_database.job_entries, youtube_ids)
+                    await self.download_tracks(entries, chat_id)
+                for job in jobs:
+                    if job.get('stage') == JOB_LISTING:
+                        await self.music_download(job.get('url'), chat_id, job.get('id'))
+            except Exception:
+                self.logger.exception(f'Failed to resume jobs of chat {chat_id}')
+
+    async def search(self, update: Update, context: CallbackContext):
+        chat_id = update.effective_chat.id
+        songs = await self.music_database.search_async(' '.join(context.args), self.search_results)
+        if not songs:
+            await self.send_message(chat_id, text='Nothing found in library.')
+            return
+        # library songs are on telegram already, re-sending costs no upload
+        for song in songs:
+            await self.send_audio(chat_id,
+                                  audio=song.get('telegram_id'),
+                                  caption=self.caption(song))
+
+    def caption(self, song: dict) -> str:
+        # shared audio has no youtube link
+        return f'https://youtu.be/{song.get("youtube_id")}' if song.get('youtube_id') else ''
+
+    async def inline_query(self, update: Update, context: CallbackContext):
+        query = update.inline_query.query
+        songs = await self.music_database.search_async(query, self.inline_results) if query else []
+        results = [InlineQueryResultCachedAudio(id=song.get('youtube_id') or song.get('telegram_unique_id'),
+                                                audio_file_id=song.get('telegram_id'),
+                                                caption=self.caption(song))
+                   for song in songs]
+        await self.rate_limiter.acquire()
+        await update.inline_query.answer(results, cache_time=300)
+
     async def audio(self, update: Update, context: CallbackContext):
-        audio_file = update.effective_message.audio.get_file()
-        filename = audio_file.download()
-        move(filename, f'{self.music_path}{filename}')
-        file_id = update.effective_message.audio.file_id
-        await self.check_send_rate()
-        await self.bot.send_audio(chat_id=update.effective_chat.id, audio=file_id)
-        await self.check_send_rate()
+        audio = update.effective_message.audio
+        # re-shares of the same file carry the same file_unique_id
+        if not (self.audio_ingest.queued(audio.file_unique_id) or
+                await self.music_database.audio_shared_async(audio.file_unique_id)):
+            await self.audio_ingest.submit({
+                'filename': await self.download_audio(audio),
+                'telegram_id': audio.file_id,
+                'telegram_unique_id': audio.file_unique_id,
+                'duration': audio.duration,
+                'performer': audio.performer,
+                'title': audio.title,
+            })
+        # already on telegram, send by file_id without uploading
+        await self.rate_limiter.acquire(update.effective_chat.id)
+        await self.bot.send_audio(chat_id=update.effective_chat.id, audio=audio.file_id)
+        await self.rate_limiter.acquire()
         await update.effective_message.delete()
 
+    async def download_audio(self, audio) -> str:
+        _, ext = os.path.splitext(audio.file_name or '')
+        filename = os.path.join(self.music_path, f'{audio.file_unique_id}{ext or ".mp3"}')
+        try:
+            audio_file = await audio.get_file()
+            # written to disk in chunks by httpx, never held in memory whole
+            await audio_file.download_to_drive(filename)
+        except BadRequest as err:
+            # bot api refuses files over 20 MB, the song is recorded without a local copy
+            self.logger.warning(f'Could not download shared audio {audio.file_unique_id}: {err}')
+            return ''
+        return filename
+
     async def log_update(self, update: Update, context: CallbackContext):
-        update_str = update.to_dict() if isinstance(update, Update) else str(update)
-        self.logger.info(f'Income update:\n{pformat(update_str, indent=4)}')
+        # decide before building anything, dropped updates cost one random()
+        if random() >= self.update_log_sample_rate or not self.update_logger.isEnabledFor(logging.INFO):
+            return
+        if not isinstance(update, Update):
+            self.update_logger.info('Income update %s', update)
+            return
+        message = update.effective_message
+        fields = {
+            'update_id': update.update_id,
+            'chat_id': update.effective_chat.id if update.effective_chat else None,
+            'user_id': update.effective_user.id if update.effective_user else None,
+            'audio': bool(message and message.audio),
+            'text': (message.text or '')[:80] if message else None,
+        }
+        self.update_logger.info('Income update %s', update.update_id, extra={'fields': fields})
 
     async def error(self, update: Update, context: CallbackContext):
         self.logger.error("\nException while handling an update:"
@@ -152,29 +411,65 @@ class CustomBot():
                           f"\ncontext.user_data = {str(context.user_data)}", exc_info=context.error)
 
     async def send_message(self, chat_id, **kwargs):
-        await self.check_send_rate()
+        # chat actions are not messages, only the global limit applies
+        await self.rate_limiter.acquire()
         await self.bot.send_chat_action(chat_id, ChatAction.TYPING, read_timeout=999)
-        await self.check_send_rate()
+        await self.rate_limiter.acquire(chat_id)
         message: Message = await self.bot.send_message(chat_id=chat_id, **kwargs, read_timeout=999)
         return message.message_id
 
     async def send_audio(self, chat_id, **kwargs):
-        await self.check_send_rate()
+        await self.rate_limiter.acquire()
         await self.bot.send_chat_action(chat_id, ChatAction.UPLOAD_VIDEO, read_timeout=999)
-        await self.check_send_rate()
-        return await self.bot.send_audio(chat_id, **kwargs, read_timeout=999)
+        await self.rate_limiter.acquire(chat_id)
+        # sending by telegram_id is cheap compared to uploading the file
+        stage = 'resend' if isinstance(kwargs.get('audio'), str) else 'upload'
+        with registry.stage(stage).time():
+            return await self.bot.send_audio(chat_id, **kwargs, read_timeout=999)
 
     def start(self, loop: asyncio.AbstractEventLoop):
         self.logger.info('Custom Bot started')
         self.loop = loop
         asyncio.set_event_loop(loop)
-        self.application.run_polling(timeout=999,
-                                     read_timeout=999,
-                                     write_timeout=999)
+        if self.mode == 'webhook':
+            self.start_webhook()
+        else:
+            self.application.run_polling(timeout=999,
+                                         read_timeout=999,
+                                         write_timeout=999,
+                                         # signals are delivered to the main thread only
+                                         stop_signals=None)
+
+    def start_webhook(self):
+        # telegram pushes updates to a local tornado server instead of being polled
+        self.logger.info(f'Listening for webhook on {self.webhook.get("listen", "127.0.0.1")}:{self.webhook.get("port", 8443)}')
+        self.application.run_webhook(listen=self.webhook.get('listen', '127.0.0.1'),
+                                     port=self.webhook.get('port', 8443),
+                                     url_path=self.webhook.get('url_path', ''),
+                                     webhook_url=self.webhook.get('webhook_url'),
+                                     secret_token=self.webhook.get('secret_token'),
+                                     cert=self.webhook.get('cert'),
+                                     key=self.webhook.get('key'),
+                                     # signals are delivered to the main thread only
+                                     stop_signals=None)
 
     def stop(self):
         async def stop():
-            self.application.stop_running()
+            # requests arriving from now on are only recorded as jobs
+            self.draining = True
+            if self.requests:
+                self.logger.info(f'Waiting up to {self.drain_timeout}sec for {len(self.requests)} requests')
+                _, pending = await asyncio.wait(self.requests, timeout=self.drain_timeout)
+                if pending:
+                    self.logger.warning(f'{len(pending)} requests left to resume on next start')
+            await self.audio_ingest.flush()
+            await self.music_database.disconnect_async()
             self.logger.info('Custom Bot is going to be down')
+            # last, the loop may stop as soon as polling does
+            self.application.stop_running()
 
+        if self.loop is None or not self.loop.is_running():
+            # the bot thread never got going or is gone, nothing would run stop()
+            self.logger.error('Custom Bot loop is not running, nothing to stop')
+            return
         asyncio.run_coroutine_threadsafe(stop(), self.loop).result()
@@ -0,0 +1,55 @@
+import copy
+import json
+import logging
+import logging.handlers
+
+
+class JsonFormatter(logging.Formatter):
+    """ One line JSON per record; structured fields are passed as extra={'fields': {...}} """
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            'time': self.formatTime(record, self.datefmt),
+            'level': record.levelname,
+            'name': record.name,
+            'message': record.getMessage(),
+        }
+        entry.update(getattr(record, 'fields', {}))
+        if record.exc_info:
+            entry['exc'] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            # formatted already by the worker process that logged it
+            entry['exc'] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class LogQueueHandler(logging.handlers.QueueHandler):
+    """ QueueHandler keeping exc_info, formatting is left to the listener thread """
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # the stock prepare formats the record here and drops exc_info,
+        # the listener is in this process so the record need not be picklable
+        record = copy.copy(record)
+        # args may be changed by the caller before the listener gets to them
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+
+class ProcessQueueHandler(LogQueueHandler):
+    """ LogQueueHandler of a worker process, records cross to the front process pickled """
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        record = super().prepare(record)
+        if record.exc_info:
+            # tracebacks do not pickle
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+class RelogHandler(logging.Handler):
+    """ Logs records received from worker processes again, through this process's handlers """
+
+    def emit(self, record: logging.LogRecord):
+        logging.getLogger(record.name).handle(record)
@@ -0,0 +1,108 @@
+import asyncio
+from time import monotonic
+from logging import getLogger, Logger
+
+from metrics.registry import registry
+
+
+class TokenBucket():
+    """ Token bucket kept as a single "theoretical arrival time" (GCRA).
+
+    `rate` tokens are refilled every `per` seconds, up to `burst` tokens.
+    """
+
+    def __init__(self, rate: float, per: float, burst: int = 1):
+        self.interval = per / rate
+        self.tolerance = self.interval * (burst - 1)
+        self.tat = 0.0
+
+    def earliest(self, at: float) -> float:
+        return max(at, self.tat - self.tolerance)
+
+    def reserve(self, at: float) -> None:
+        self.tat = max(self.tat, at) + self.interval
+
+    def idle(self, now: float) -> bool:
+        return self.tat <= now
+
+
+class RateLimiter():
+    """ Telegram flood limits: global, per chat and per group.
+
+    Reservations are made without awaiting in between, so concurrent
+    handlers on the same event loop cannot race each other, and chats
+    that do not share a bucket never wait for one another.
+    """
+
+    def __init__(self, global_rate: float = 30, chat_rate: float = 1, group_rate: float = 20):
+        self.logger: Logger = getLogger(__name__)
+        self.global_bucket = TokenBucket(global_rate, 1, burst=int(global_rate))
+        self.chat_rate = chat_rate
+        self.group_rate = group_rate
+        self.chats: dict[int, TokenBucket] = {}
+        self.groups: dict[int, TokenBucket] = {}
+
+        self.acquired = 0
+        self.waits = 0
+        self.waited_seconds = 0.0
+        self.max_wait = 0.0
+
+    def chat_buckets(self, chat_id: int) -> list[TokenBucket]:
+        if chat_id is None:
+            return []
+        if chat_id not in self.chats:
+            self.chats[chat_id] = TokenBucket(self.chat_rate, 1)
+        buckets = [self.chats[chat_id]]
+        # negative ids are groups, supergroups and channels
+        if chat_id < 0:
+            if chat_id not in self.groups:
+                self.groups[chat_id] = TokenBucket(self.group_rate, 60)
+            buckets.append(self.groups[chat_id])
+        return buckets
+
+    def reserve(self, buckets: list[TokenBucket]) -> float:
+        """ Reserve a slot in every bucket at once, return delay in seconds """
+        now = monotonic()
+        start = max(bucket.earliest(now) for bucket in buckets)
+        for bucket in buckets:
+            bucket.reserve(start)
+        return start - now
+
+    async def acquire(self, chat_id: int = None) -> None:
+        # the global slot is taken only once the chat's own turn has come,
+        # otherwise a chat queued far ahead would hold back every other chat
+        delay = 0.0
+        if chat_id is not None:
+            delay += await self.wait(self.reserve(self.chat_buckets(chat_id)))
+            if len(self.chats) > 1024:
+                self.forget_idle(monotonic())
+        delay += await self.wait(self.reserve([self.global_bucket]))
+
+        self.acquired += 1
+        registry.stage('rate_limit_wait').observe(delay)
+        if delay > 0:
+            self.waits += 1
+            self.waited_seconds += delay
+            self.max_wait = max(self.max_wait, delay)
+            self.logger.debug(f'Chat {chat_id} waited {delay:.3f}sec for send slot')
+
+    async def wait(self, delay: float) -> float:
+        if delay > 0:
+            await asyncio.sleep(delay)
+            return delay
+        return 0.0
+
+    def forget_idle(self, now: float):
+        # an idle bucket behaves exactly like a fresh one
+        for buckets in (self.chats, self.groups):
+            for chat_id in [chat_id for chat_id, bucket in buckets.items() if bucket.idle(now)]:
+                del buckets[chat_id]
+
+    def stats(self) -> dict:
+        return {
+            'acquired': self.acquired,
+            'waits': self.waits,
+            'waited_seconds': round(self.waited_seconds, 3),
+            'max_wait': round(self.max_wait, 3),
+            'tracked_chats': len(self.chats),
+        }
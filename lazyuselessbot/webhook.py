@@ -0,0 +1,25 @@
+""" Post a fake Update to a locally running webhook.
+
+python -m lazyuselessbot.webhook http://127.0.0.1:8443/bot update.json [secret_token]
+"""
+import sys
+import json
+import httpx
+
+
+def post_update(url: str, update: dict, secret_token: str = None) -> httpx.Response:
+    headers = {'X-Telegram-Bot-Api-Secret-Token': secret_token} if secret_token else {}
+    return httpx.post(url, json=update, headers=headers)
+
+
+def main():
+    url, filename = sys.argv[1], sys.argv[2]
+    secret_token = sys.argv[3] if len(sys.argv) > 3 else None
+    with open(filename, 'r', encoding='utf-8') as update_file:
+        update: dict = json.load(update_file)
+    response = post_update(url, update, secret_token)
+    print(f'{response.status_code} {response.text}')
+
+
+if __name__ == '__main__':
+    main()
@@ -1,5 +1,6 @@
 from lazyuselessbot.bot import CustomBot
 from music.database import MusicDatabase
+from metrics.registry import registry
 
 
 class SimpleMenu():
@@ -24,6 +25,30 @@ class SimpleMenu():
         except:
             pass
 
+    def print_cache_stats(self):
+        self.music_database.print_cache_stats()
+
+    def print_dead_letters(self):
+        self.music_database.print_dead_letters()
+
+    def print_jobs(self):
+        self.music_database.print_jobs()
+
+    def print_pipeline_stats(self):
+        print('Send rate limiter:')
+        for key, value in self.bot.rate_limiter.stats().items():
+            print(f'{key:>15} | {value}')
+        print('Download retries:')
+        for key, value in self.music_database.downloader.retry_policy.stats().items():
+            print(f'{key:>15} | {value}')
+        print('Transcoder:')
+        for key, value in self.music_database.downloader.transcoder.stats().items():
+            print(f'{key:>15} | {value}')
+
+    def print_metrics(self):
+        print('Metrics:')
+        print(registry.summary())
+
     def display_menu(self):
         while True:
             option = input('\n'.join(('Simple menu:',
@@ -31,6 +56,11 @@ class SimpleMenu():
                                       '1. Print music database.',
                                       #   '2. Drop table.',
                                       '3. Delete song from database.',
+                                      '4. Print song cache statistics.',
+                                      '5. Print failed downloads.',
+                                      '6. Print metrics summary.',
+                                      '7. Print pending jobs.',
+                                      '8. Print pipeline statistics.',
                                       '')))
             if option == '0':
                 self.shutdown()
@@ -41,3 +71,13 @@ class SimpleMenu():
             #     self.drop_table()
             elif option == '3':
                 self.delete_music()
+            elif option == '4':
+                self.print_cache_stats()
+            elif option == '5':
+                self.print_dead_letters()
+            elif option == '6':
+                self.print_metrics()
+            elif option == '7':
+                self.print_jobs()
+            elif option == '8':
+                self.print_pipeline_stats()
@@ -0,0 +1,69 @@
+import json
+import threading
+from logging import getLogger, Logger
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+from metrics.registry import Registry
+
+
+class MetricsExporter():
+    """ Serves /metrics in prometheus text format and/or dumps JSON snapshots to a file """
+
+    def __init__(self, registry: Registry):
+        self.logger: Logger = getLogger(__name__)
+        self.registry = registry
+        self.server: ThreadingHTTPServer = None
+        self.stopped = threading.Event()
+        self.threads: list[threading.Thread] = []
+
+    def load_settings(self, settings: dict):
+        # {"listen": "127.0.0.1", "port": 9100, "json_file": "./logs/metrics.json", "json_interval": 60}
+        self.listen = settings.get('listen', '127.0.0.1')
+        self.port = settings.get('port')
+        self.json_file = settings.get('json_file')
+        self.json_interval = settings.get('json_interval', 60)
+
+    def start(self):
+        if self.port:
+            registry = self.registry
+
+            class Handler(BaseHTTPRequestHandler):
+                def do_GET(self):
+                    if self.path != '/metrics':
+                        self.send_error(404)
+                        return
+                    body = registry.prometheus().encode('utf-8')
+                    self.send_response(200)
+                    self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+                    self.send_header('Content-Length', f'{len(body)}')
+                    self.end_headers()
+                    self.wfile.write(body)
+
+                def log_message(self, format, *args):
+                    pass
+
+            self.server = ThreadingHTTPServer((self.listen, self.port), Handler)
+            self.threads.append(threading.Thread(target=self.server.serve_forever, name='metrics-http', daemon=True))
+            self.logger.info(f'Serving metrics on http://{self.listen}:{self.port}/metrics')
+        if self.json_file:
+            self.threads.append(threading.Thread(target=self.dump_forever, name='metrics-json', daemon=True))
+        for thread in self.threads:
+            thread.start()
+
+    def dump(self):
+        with open(self.json_file, 'w', encoding='utf-8') as metrics_file:
+            json.dump(self.registry.snapshot(), metrics_file, indent=4)
+
+    def dump_forever(self):
+        while not self.stopped.wait(self.json_interval):
+            self.dump()
+
+    def stop(self):
+        self.stopped.set()
+        if self.server:
+            self.server.shutdown()
+            self.server.server_close()
+        for thread in self.threads:
+            thread.join()
+        if self.json_file:
+            self.dump()
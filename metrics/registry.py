@@ -0,0 +1,228 @@
+import threading
+from bisect import bisect_left
+from time import monotonic
+from contextlib import contextmanager
+
+# seconds; telegram calls take milliseconds, downloads and transcodes minutes
+BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+
+
+def render_labels(labels: tuple) -> str:
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{key}="{value}"' for key, value in labels) + '}'
+
+
+class Counter():
+    kind = 'counter'
+
+    def __init__(self, function=None):
+        # function reads a counter kept elsewhere, e.g. SongCache.hits
+        self.function = function
+        self.count = 0
+        self.lock = threading.Lock()
+
+    def inc(self, amount: float = 1):
+        with self.lock:
+            self.count += amount
+
+    def value(self) -> float:
+        # count of a function counter holds what other processes merged in
+        return (self.function() if self.function else 0) + self.count
+
+    def samples(self, name: str, labels: tuple) -> list[str]:
+        return [f'{name}{render_labels(labels)} {self.value()}']
+
+    def snapshot(self):
+        return self.value()
+
+    def state(self) -> float:
+        return self.value()
+
+    @staticmethod
+    def subtract(state: float, previous: float) -> float:
+        return state - previous
+
+    def merge(self, change: float):
+        self.inc(change)
+
+
+class Gauge(Counter):
+    kind = 'gauge'
+
+    def set(self, value: float):
+        with self.lock:
+            self.count = value
+
+
+class Histogram():
+    kind = 'histogram'
+
+    def __init__(self, buckets: tuple = BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+        self.lock = threading.Lock()
+
+    def observe(self, value: float):
+        with self.lock:
+            self.counts[bisect_left(self.buckets, value)] += 1
+            self.sum += value
+            self.count += 1
+
+    @contextmanager
+    def time(self):
+        start = monotonic()
+        try:
+            yield
+        finally:
+            self.observe(monotonic() - start)
+
+    def quantile(self, q: float) -> float:
+        """ Estimate from buckets, interpolating inside the bucket the quantile falls in """
+        with self.lock:
+            counts, count = list(self.counts), self.count
+        if not count:
+            return 0.0
+        rank = q * count
+        seen = 0
+        for index, bucket_count in enumerate(counts):
+            if seen + bucket_count >= rank and bucket_count:
+                lower = self.buckets[index - 1] if index > 0 else 0.0
+                upper = self.buckets[index] if index < len(self.buckets) else self.buckets[-1]
+                return lower + (upper - lower) * (rank - seen) / bucket_count
+            seen += bucket_count
+        return self.buckets[-1]
+
+    def samples(self, name: str, labels: tuple) -> list[str]:
+        with self.lock:
+            counts, total, count = list(self.counts), self.sum, self.count
+        lines, cumulative = [], 0
+        for bucket, bucket_count in zip(self.buckets + ('+Inf', ), counts):
+            cumulative += bucket_count
+            lines.append(f'{name}_bucket{render_labels(labels + (("le", bucket), ))} {cumulative}')
+        lines.append(f'{name}_sum{render_labels(labels)} {total}')
+        lines.append(f'{name}_count{render_labels(labels)} {count}')
+        return lines
+
+    def state(self) -> tuple:
+        with self.lock:
+            return tuple(self.counts), self.sum, self.count
+
+    @staticmethod
+    def subtract(state: tuple, previous: tuple) -> tuple:
+        return (tuple(count - before for count, before in zip(state[0], previous[0])),
+                state[1] - previous[1], state[2] - previous[2])
+
+    def merge(self, change: tuple):
+        counts, total, count = change
+        with self.lock:
+            self.counts = [mine + theirs for mine, theirs in zip(self.counts, counts)]
+            self.sum += total
+            self.count += count
+
+    def snapshot(self) -> dict:
+        with self.lock:
+            count, total = self.count, self.sum
+        return {
+            'count': count,
+            'sum': round(total, 3),
+            'mean': round(total / count, 3) if count else 0.0,
+            'p50': round(self.quantile(0.5), 3),
+            'p95': round(self.quantile(0.95), 3),
+        }
+
+
+# metrics worker processes send back to the front process
+MERGEABLE = {
+    Counter.kind: Counter,
+    Histogram.kind: Histogram,
+}
+
+
+class Registry():
+    """ Metrics by name and labels, exported as prometheus text or a JSON-able dict """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # name → (help, {labels: metric})
+        self.metrics: dict[str, tuple[str, dict]] = {}
+
+    def get(self, factory, name: str, help: str, labels: dict, *args):
+        key = tuple(sorted((labels or {}).items()))
+        with self.lock:
+            _, series = self.metrics.setdefault(name, (help, {}))
+            if key not in series:
+                series[key] = factory(*args)
+            return series[key]
+
+    def counter(self, name: str, help: str = '', labels: dict = None, function=None) -> Counter:
+        return self.get(Counter, name, help, labels, function)
+
+    def gauge(self, name: str, help: str = '', labels: dict = None, function=None) -> Gauge:
+        return self.get(Gauge, name, help, labels, function)
+
+    def histogram(self, name: str, help: str = '', labels: dict = None) -> Histogram:
+        return self.get(Histogram, name, help, labels)
+
+    def remove(self, name: str):
+        with self.lock:
+            self.metrics.pop(name, None)
+
+    def stage(self, stage: str) -> Histogram:
+        """ Histogram of one pipeline stage: extract, download, transcode, upload.. """
+        return self.histogram('stage_seconds', 'Time spent per pipeline stage', {'stage': stage})
+
+    def items(self):
+        with self.lock:
+            return [(name, help, list(series.items())) for name, (help, series) in self.metrics.items()]
+
+    def state(self) -> dict:
+        """ Totals of counters and histograms; gauges describe one process and are left out """
+        return {(metric.kind, name, help, labels): metric.state()
+                for name, help, series in self.items()
+                for labels, metric in series if metric.kind in MERGEABLE}
+
+    def changes(self, since: dict) -> tuple[dict, dict]:
+        """ Growth since an earlier state, and the current state to diff against next time """
+        state = self.state()
+        changes = {}
+        for key, value in state.items():
+            previous = since.get(key)
+            if previous is None:
+                changes[key] = value
+            elif value != previous:
+                changes[key] = MERGEABLE[key[0]].subtract(value, previous)
+        return changes, state
+
+    def merge(self, changes: dict):
+        """ Add changes of another process's registry to this one """
+        for (kind, name, help, labels), change in changes.items():
+            self.get(MERGEABLE[kind], name, help, dict(labels)).merge(change)
+
+    def prometheus(self) -> str:
+        lines = []
+        for name, help, series in self.items():
+            if not series:
+                continue
+            lines.append(f'# HELP {name} {help}')
+            lines.append(f'# TYPE {name} {series[0][1].kind}')
+            for labels, metric in series:
+                lines.extend(metric.samples(name, labels))
+        return '\n'.join(lines) + '\n'
+
+    def snapshot(self) -> dict:
+        return {name: {','.join(f'{key}={value}' for key, value in labels) or 'total': metric.snapshot()
+                       for labels, metric in series}
+                for name, _, series in self.items()}
+
+    def summary(self) -> str:
+        lines = []
+        for name, values in self.snapshot().items():
+            for labels, value in values.items():
+                lines.append(f'{name:>30} | {labels:>25} | {value}')
+        return '\n'.join(lines)
+
+
+registry = Registry()
@@ -0,0 +1,53 @@
+import threading
+from cachetools import TTLCache
+
+
+class SongCache():
+    """ youtube_id → library record, bounded by size (LRU) and age (TTL).
+
+    Shared between the event loop and download workers, hence the lock.
+    """
+
+    def __init__(self, maxsize: int = 4096, ttl: float = 24 * 60 * 60):
+        self.maxsize = maxsize
+        self.songs = TTLCache(maxsize=maxsize, ttl=ttl)
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get_many(self, youtube_ids: list[str]) -> tuple[dict[str, dict], list[str]]:
+        """ Return cached records and the ids that still have to be looked up """
+        found, missing = {}, []
+        with self.lock:
+            for youtube_id in youtube_ids:
+                song = self.songs.get(youtube_id)
+                if song is None:
+                    missing.append(youtube_id)
+                else:
+                    found[youtube_id] = dict(song)
+            self.hits += len(found)
+            self.misses += len(missing)
+        return found, missing
+
+    def put_many(self, songs) -> None:
+        with self.lock:
+            for song in songs:
+                # shared audio has no youtube_id to look it up by
+                if song.get('youtube_id'):
+                    self.songs[song.get('youtube_id')] = dict(song)
+
+    def invalidate(self, youtube_ids: list[str]) -> None:
+        with self.lock:
+            for youtube_id in youtube_ids:
+                self.songs.pop(youtube_id, None)
+
+    def stats(self) -> dict:
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                'size': len(self.songs),
+                'maxsize': self.maxsize,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_ratio': round(self.hits / lookups, 3) if lookups else 0.0,
+            }
@@ -1,25 +1,66 @@
-import os
 import contextlib
 from json import load, dump
-from mutagen.mp3 import MP3
-from unicodedata import normalize
 from logging import getLogger, Logger
-from sqlalchemy import create_engine, inspect
+from sqlalchemy import create_engine, inspect, bindparam, event
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.orm import sessionmaker, scoped_session
-from sqlalchemy.sql import exists, update, delete, select
-from mutagen.id3 import TIT2, TPE1, TDRC, TCON, TALB, TRCK, COMM
+from sqlalchemy.pool import AsyncAdaptedQueuePool
+from sqlalchemy.sql import exists, update, delete, select, insert
 
-from music.music import Music, Base
+from music.music import Music, DeadLetter, Job, Base, JOB_LISTING, JOB_QUEUED, JOB_DOWNLOADED
 from music.downloader import MusicDownloader
+from music.cache import SongCache
+from music.retry import DownloadFailed
+from music.thumbnails import ThumbnailFetcher
+from music.search import SearchIndex
+from music.storage import AudioStorage
+from music.migrations import migrate
+from metrics.registry import registry
 
 # id  | youtube_id    | filename  | telegram_id   | duration  | performer         | Title         | thumb
 # 0   | xxxxxxxxxxxx  | temp_.mp3 | 1235          | 120       | Three Days Grace  | The Real You  | cover.jpeg
 
 
+# keeps IN (...) below SQLite's default bound parameter limit
+CHUNK_SIZE = 500
+
+
+# sync driver → asyncio driver of the same database
+ASYNC_DRIVERS = {
+    'sqlite': 'sqlite+aiosqlite',
+    'postgresql': 'postgresql+asyncpg',
+}
+
+
+def chunks(items: list, size: int = CHUNK_SIZE):
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+
+def async_url(url: str) -> str:
+    url = make_url(url)
+    return url.set(drivername=ASYNC_DRIVERS.get(url.drivername, url.drivername)).render_as_string(hide_password=False)
+
+
+def set_sqlite_pragma(dbapi_connection, connection_record):
+    # WAL lets the bot read while download workers write
+    cursor = dbapi_connection.cursor()
+    cursor.execute('PRAGMA journal_mode=WAL')
+    cursor.execute('PRAGMA synchronous=NORMAL')
+    cursor.execute('PRAGMA busy_timeout=5000')
+    cursor.close()
+
+
 class MusicDatabase():
     def __init__(self, downloader: MusicDownloader):
         self.logger: Logger = getLogger(__name__)
         self.downloader = downloader
+        self.cache = SongCache()
+        registry.counter('cache_hits_total', 'Song cache hits', function=lambda: self.cache.hits)
+        registry.counter('cache_misses_total', 'Song cache misses', function=lambda: self.cache.misses)
+        registry.gauge('cache_size', 'Songs held in cache', function=lambda: len(self.cache.songs))
 
     @contextlib.contextmanager
     def ManagedSession(self):
@@ -35,22 +76,74 @@ class MusicDatabase():
             session.close()
             self.Session.remove()
 
+    @contextlib.asynccontextmanager
+    async def AsyncManagedSession(self):
+        async with self.AsyncSession() as session:
+            try:
+                yield session
+                await session.commit()
+            except Exception:
+                await session.rollback()
+                raise
+
     def load_settings(self, filename: str):
         with open(filename, 'r') as settings:
             settings = load(settings)
         self.songs_path = settings.get('songs_path')
         self.thumbnails_path = settings.get('thumbnails_path')
         self.music_database = settings.get('music_database')
+        self.async_music_database = settings.get('async_music_database') or async_url(self.music_database)
+        self.pool_size = settings.get('pool_size', 5)
+        self.cache = SongCache(settings.get('cache_size', 4096),
+                               settings.get('cache_ttl', 24 * 60 * 60))
+        # bytes of local audio kept once songs are on telegram, null keeps all
+        self.storage = AudioStorage(self.songs_path, settings.get('disk_budget'))
+        self.thumbnails = ThumbnailFetcher(self.thumbnails_path, settings.get('ffmpeg', 'ffmpeg'))
 
     def connect(self):
-        self.engine = create_engine(self.music_database)
+        self.engine = create_engine(self.music_database, **self.pool_options(self.music_database))
         self.session_factory = sessionmaker(bind=self.engine)
         self.Session = scoped_session(self.session_factory)
         self.inspector = inspect(self.engine)
+        self.search_index = SearchIndex(self.engine)
+
+        # used from the bot's event loop, the sync engine from download workers
+        self.async_engine = create_async_engine(self.async_music_database,
+                                                **self.pool_options(self.async_music_database, async_driver=True))
+        self.AsyncSession = async_sessionmaker(self.async_engine, expire_on_commit=False)
+
+        if self.engine.dialect.name == 'sqlite':
+            event.listen(self.engine, 'connect', set_sqlite_pragma)
+            event.listen(self.async_engine.sync_engine, 'connect', set_sqlite_pragma)
+
+        self.thumbnails.start()
+
+    def disconnect(self):
+        self.thumbnails.close()
+        self.engine.dispose()
+
+    def pool_options(self, url: str, async_driver: bool = False) -> dict:
+        url = make_url(url)
+        # in-memory sqlite lives in a single connection, there is nothing to pool
+        if url.get_backend_name() == 'sqlite' and url.database in (None, '', ':memory:'):
+            return {}
+        options = {'pool_size': self.pool_size, 'max_overflow': self.pool_size, 'pool_pre_ping': True}
+        if async_driver:
+            # aiosqlite defaults to NullPool, which takes no pool sizes
+            options['poolclass'] = AsyncAdaptedQueuePool
+        return options
+
+    async def disconnect_async(self):
+        await self.async_engine.dispose()
 
     def create_table_if_no_exist(self) -> None:
-        if not self.inspector.has_table(Music.__tablename__):
-            Base.metadata.create_all(self.engine)
+        # creates only the tables that are missing
+        Base.metadata.create_all(self.engine)
+        migrate(self.engine)
+        # tables created before the index existed
+        for index in Music.__table__.indexes:
+            index.create(self.engine, checkfirst=True)
+        self.search_index.create()
 
     def drop_table(self) -> None:
         Music.__table__.drop(self.engine)
@@ -61,17 +154,239 @@ class MusicDatabase():
 
     def delete_song(self, id: int) -> None:
         with self.ManagedSession() as session:
+            youtube_id, filename = session.execute(select(Music.youtube_id, Music.filename).where(Music.id == id)).one()
             session.execute(delete(Music).where(Music.id == id))
+        self.cache.invalidate([youtube_id])
+        self.storage.release([filename])
 
     def update_record(self, youtube_id: str, telegram_id: str) -> None:
+        self.update_records({youtube_id: telegram_id})
+
+    def update_records(self, telegram_ids: dict[str, str]) -> None:
+        """ Set telegram_id for many youtube_ids in one executemany """
         with self.ManagedSession() as session:
-            session.execute(update(Music).
-                            where(Music.youtube_id == youtube_id).
-                            values(telegram_id=telegram_id))
+            session.execute(*self.update_records_statement(telegram_ids))
+        self.cache.invalidate(list(telegram_ids))
+
+    def update_records_statement(self, telegram_ids: dict[str, str]) -> tuple:
+        music = Music.__table__
+        return (update(music).
+                where(music.c.youtube_id == bindparam('b_youtube_id')).
+                values(telegram_id=bindparam('b_telegram_id')),
+                [{'b_youtube_id': youtube_id, 'b_telegram_id': telegram_id}
+                 for youtube_id, telegram_id in telegram_ids.items()])
+
+    async def audio_exist_async(self, youtube_id: str) -> bool:
+        async with self.AsyncManagedSession() as session:
+            return await session.scalar(select(exists().where(Music.youtube_id == youtube_id)))
+
+    async def update_record_async(self, youtube_id: str, telegram_id: str) -> None:
+        await self.update_records_async({youtube_id: telegram_id})
+
+    async def update_records_async(self, telegram_ids: dict[str, str]) -> None:
+        async with self.AsyncManagedSession() as session:
+            await session.execute(*self.update_records_statement(telegram_ids))
+        self.cache.invalidate(list(telegram_ids))
+
+    async def get_audio_async(self, youtube_id: str) -> dict:
+        """ Library record of youtube_id or None, never downloads """
+        return (await self.get_audios_async([youtube_id])).get(youtube_id)
+
+    async def get_audios_async(self, youtube_ids: list[str]) -> dict[str, dict]:
+        songs, missing = self.cache.get_many(list(set(youtube_ids)))
+        if not missing:
+            return songs
+        async with self.AsyncManagedSession() as session:
+            for ids in chunks(missing):
+                for music in await session.scalars(select(Music).where(Music.youtube_id.in_(ids))):
+                    songs[music.youtube_id] = music.to_dict()
+        self.cache.put_many([songs[youtube_id] for youtube_id in missing if youtube_id in songs])
+        return songs
+
+    async def audio_shared_async(self, telegram_unique_id: str) -> bool:
+        async with self.AsyncManagedSession() as session:
+            return await session.scalar(select(exists().where(Music.telegram_unique_id == telegram_unique_id)))
+
+    def ingest_songs(self, items: list[dict]) -> None:
+        """ Record audio shared with the bot; runs off the loop, reads tags of the whole batch """
+        unique_ids = list({item.get('telegram_unique_id') for item in items})
+        with self.ManagedSession() as session:
+            known = set()
+            for ids in chunks(unique_ids):
+                known.update(session.scalars(select(Music.telegram_unique_id).where(Music.telegram_unique_id.in_(ids))))
+        songs = []
+        for item in items:
+            if item.get('telegram_unique_id') in known:
+                continue
+            known.add(item.get('telegram_unique_id'))
+            songs.append(self.ingest_song(item))
+        self.insert_songs(songs)
+        self.logger.info(f'Recorded {len(songs)} shared songs')
+
+    def ingest_song(self, item: dict) -> dict:
+        filename = item.get('filename')
+        performer, title, duration = item.get('performer'), item.get('title'), item.get('duration')
+        if filename:
+            from mutagen import File as MutagenFile, MutagenError
+            # tags of the file win over what telegram guessed
+            try:
+                audio = MutagenFile(filename, easy=True)
+            except MutagenError as err:
+                self.logger.warning(f'Could not read tags of {filename}, using telegram ones: {err}')
+                audio = None
+            if audio is not None:
+                tags = audio.tags or {}
+                performer = (tags.get('artist') or [performer])[0]
+                title = (tags.get('title') or [title])[0]
+                duration = duration or int(audio.info.length)
+            filename, _ = self.storage.store(filename)
+            # already on telegram, the local copy is evictable right away
+            self.storage.release([filename])
+        return {
+            'youtube_id': None,
+            'filename': filename or '',
+            'telegram_id': item.get('telegram_id'),
+            'duration': duration or 0,
+            'performer': performer or 'NA',
+            'title': title or 'NA',
+            'thumbnail': '',
+            'telegram_unique_id': item.get('telegram_unique_id'),
+        }
+
+    def search(self, query: str, limit: int = 10) -> list[dict]:
+        statement = self.search_index.statement(query, limit)
+        if statement is None:
+            return []
+        with self.ManagedSession() as session:
+            return [music.to_dict() for music in session.scalars(statement)]
+
+    async def search_async(self, query: str, limit: int = 10) -> list[dict]:
+        statement = self.search_index.statement(query, limit)
+        if statement is None:
+            return []
+        async with self.AsyncManagedSession() as session:
+            return [music.to_dict() for music in await session.scalars(statement)]
+
+    def insert_songs(self, songs: list[dict]) -> None:
+        if songs:
+            with self.ManagedSession() as session:
+                session.execute(insert(Music), songs)
+
+    def list_entries(self, job_id: int, url: str) -> list[dict]:
+        """ Flat entries of the url of a listing job, the only part of listing that needs youtube """
+        try:
+            return self.downloader.retrive_entries(url)
+        except DownloadFailed as err:
+            # a link that cannot be listed is not worth resuming
+            self.add_dead_letter(None, err)
+            with self.ManagedSession() as session:
+                session.execute(delete(Job).where(Job.id == job_id))
+            raise
+
+    def queue_entries(self, job_id: int, chat_id: int, entries: list[dict]) -> list[dict]:
+        """ Library records for known entries; the listing job is replaced by a job per track in one transaction """
+        entries = self.library_entries(entries)
+        with self.ManagedSession() as session:
+            session.execute(delete(Job).where(Job.id == job_id))
+            if entries:
+                session.execute(insert(Job), [{'chat_id': chat_id,
+                                               'url': f'https://youtu.be/{entry.get("id") or entry.get("youtube_id")}',
+                                               'youtube_id': entry.get('id') or entry.get('youtube_id'),
+                                               'stage': JOB_QUEUED} for entry in entries])
+        return entries
+
+    def job_entries(self, youtube_ids: list[str]) -> list[dict]:
+        """ Entries of resumed track jobs, library records for songs already known """
+        songs = self.get_audios(youtube_ids)
+        return [songs.get(youtube_id, {'_type': 'url', 'id': youtube_id, 'url': f'https://youtu.be/{youtube_id}'})
+                for youtube_id in youtube_ids]
+
+    async def add_job_async(self, chat_id: int, url: str) -> int:
+        async with self.AsyncManagedSession() as session:
+            job = Job(chat_id=chat_id, url=url, stage=JOB_LISTING)
+            session.add(job)
+            await session.flush()
+            return job.id
+
+    async def finish_jobs_async(self, chat_id: int, youtube_ids: list[str]) -> None:
+        async with self.AsyncManagedSession() as session:
+            for ids in chunks(youtube_ids):
+                await session.execute(delete(Job).where(Job.chat_id == chat_id, Job.youtube_id.in_(ids)))
+
+    async def resume_jobs_async(self, max_attempts: int) -> list[dict]:
+        """ Jobs left by the previous run, oldest first; ones resumed too often are dropped """
+        async with self.AsyncManagedSession() as session:
+            await session.execute(update(Job).values(attempts=Job.attempts + 1))
+            dropped = await session.execute(delete(Job).where(Job.attempts > max_attempts))
+            if dropped.rowcount:
+                self.logger.warning(f'Dropped {dropped.rowcount} jobs resumed {max_attempts} times already')
+            return [job.to_dict() for job in await session.scalars(select(Job).order_by(Job.id))]
+
+    def print_jobs(self):
+        print('Pending jobs:')
+        print(f'{"id":>4} | {"chat_id":>14} | {"stage":>10} | {"attempts":>8} | url')
+        with self.ManagedSession() as session:
+            for job in session.query(Job).order_by(Job.id):
+                print(f'{job.id:>4} | {job.chat_id:>14} | {job.stage:>10} | {job.attempts:>8} | {job.url}')
+
+    def get_entries(self, url: str) -> list[dict]:
+        """ Flat playlist entries, already known ones replaced by their library record """
+        return self.library_entries(self.downloader.retrive_entries(url))
+
+    def library_entries(self, entries: list[dict]) -> list[dict]:
+        songs = self.get_audios([entry.get('id') for entry in entries])
+        return [songs.get(entry.get('id'), entry) for entry in entries]
+
+    def get_audios(self, youtube_ids: list[str]) -> dict[str, dict]:
+        songs, missing = self.cache.get_many(list(set(youtube_ids)))
+        if not missing:
+            return songs
+        with self.ManagedSession() as session:
+            for ids in chunks(missing):
+                for music in session.scalars(select(Music).where(Music.youtube_id.in_(ids))):
+                    songs[music.youtube_id] = music.to_dict()
+        self.cache.put_many([songs[youtube_id] for youtube_id in missing if youtube_id in songs])
+        return songs
+
+    def get_song(self, entry: dict) -> dict:
+        # library records are returned as is, without any request to youtube
+        if 'telegram_id' in entry:
+            return entry
+        try:
+            info = self.downloader.resolve_info(entry)
+            # one short session per entry, nothing is held open across downloads
+            with self.ManagedSession() as session:
+                song = self.get_audio(session, info)
+                # the file is ready, a restart only has to upload it
+                session.execute(update(Job).
+                                where(Job.youtube_id == info.get('id'), Job.stage == JOB_QUEUED).
+                                values(stage=JOB_DOWNLOADED))
+                return song
+        except DownloadFailed as err:
+            self.add_dead_letter(entry.get('id'), err)
+            raise
+        except IntegrityError:
+            # someone else inserted the same song meanwhile, use their record
+            song = self.get_audios([info.get('id')]).get(info.get('id'))
+            if song is None:
+                raise
+            self.logger.info(f"Song id: {info.get('id')} was recorded concurrently")
+            return song
+
+    def add_dead_letter(self, youtube_id: str, err: DownloadFailed) -> None:
+        with self.ManagedSession() as session:
+            session.add(DeadLetter(youtube_id=youtube_id,
+                                   url=err.url,
+                                   error=err.reason,
+                                   attempts=err.attempts,
+                                   permanent=int(err.permanent)))
 
-    def get_music(self, url: str) -> list:
+    def print_dead_letters(self):
+        print('Failed downloads:')
+        print(f'{"id":>3} | {"youtube_id":>13} | {"attempts":>8} | {"failed_at":>19} | error')
         with self.ManagedSession() as session:
-            return [self.get_audio(session, info) for info in self.downloader.retrive_songs_info(url)]
+            for letter in session.query(DeadLetter).order_by(DeadLetter.id):
+                print(f'{letter.id:>3} | {letter.youtube_id or "":>13} | {letter.attempts:>8} | {letter.failed_at:%Y-%m-%d %H:%M:%S} | {letter.error}')
 
     def get_audio(self, session, info: dict) -> dict:
         music = session.execute(select(Music).
@@ -82,15 +397,13 @@ class MusicDatabase():
             return self.download_song(session, info).to_dict()
 
     def download_song(self, session, info: dict) -> Music:
-        filename, artist, track = self.generate_filename(info)
-        filename = self.normalize_filename(filename)
+        _, artist, track = self.generate_filename(info)
 
-        song = self.downloader.song(info,
-                                    os.path.join(self.songs_path, filename))
-        self.add_audio_tags(song, info)
+        # thumbnail is fetched while the audio downloads
+        thumb = self.thumbnails.fetch(info.get('thumbnail')) if info.get('thumbnail') else None
 
-        thumb = self.downloader.thumb(info.get('thumbnail'),
-                                      os.path.join(self.thumbnails_path, filename))
+        song = self.store_song(info)
+        thumb = self.thumbnail_result(thumb)
 
         entry = Music(youtube_id=info.get('id'),
                       filename=song,
@@ -103,6 +416,42 @@ class MusicDatabase():
         self.logger.info(f"Downloaded song id: {info.get('id')}, performer: {artist}, title: {track}")
         return entry
 
+    def store_song(self, info: dict) -> str:
+        source = self.downloader.song(info, self.storage.temporary(info.get('id')))
+        song, created = self.storage.store(source)
+        # identical audio stored before is tagged already
+        if created:
+            with registry.stage('tag').time():
+                self.add_audio_tags(song, info)
+        return song
+
+    def refetch(self, song: dict) -> dict:
+        """ Download a library song again, its local copy was evicted or telegram lost the file """
+        youtube_id = song.get('youtube_id')
+        info = self.downloader.resolve_info({'_type': 'url', 'id': youtube_id, 'url': f'https://youtu.be/{youtube_id}'})
+        filename = self.store_song(info)
+        with self.ManagedSession() as session:
+            session.execute(update(Music).
+                            where(Music.youtube_id == youtube_id).
+                            values(filename=filename, telegram_id=''))
+        self.cache.invalidate([youtube_id])
+        self.logger.info(f'Fetched song id: {youtube_id} again')
+        return dict(song, filename=filename, telegram_id='')
+
+    def load_storage(self):
+        evicted = self.storage.scan(self.songs())
+        self.logger.info(f'Audio storage holds {self.storage.size} bytes, evicted {len(evicted)} songs')
+
+    def thumbnail_result(self, thumb) -> str:
+        if thumb is None:
+            return ''
+        try:
+            return thumb.result()
+        except Exception as err:
+            # a song without cover is still a song
+            self.logger.warning(f'Thumbnail fetch failed: {err}')
+            return ''
+
     def generate_filename(self, info: dict):
         # %(artist)s%(track)s
         # %(uploader)s%(title)s
@@ -118,12 +467,12 @@ class MusicDatabase():
             # print(f'Press F to pay respect before getting information from MusicBrainz.')
         return filename, artist, track
 
-    def normalize_filename(self, filename: str):
-        for symbol in ['<', '>', ':', '"', '/', '\\', '|', '?', '*']:
-            filename = filename.replace(symbol, '')
-        return normalize('NFKD', filename).encode('cp1251', 'ignore').decode('cp1251')
-
     def add_audio_tags(self, filename: str, info: dict):
+        if filename.endswith('.m4a'):
+            return self.add_mp4_tags(filename, info)
+        # mutagen is imported on the first song tagged, not at start
+        from mutagen.mp3 import MP3
+        from mutagen.id3 import TIT2, TPE1, TDRC, TCON, TALB, TRCK, COMM
         audio = MP3(filename)
         tags = {
             # Title/songname/content description
@@ -144,12 +493,29 @@ class MusicDatabase():
         audio.update(tags)
         audio.save()
 
+    def add_mp4_tags(self, filename: str, info: dict):
+        from mutagen.mp4 import MP4
+        audio = MP4(filename)
+        tags = {
+            '\xa9nam': f"{info.get('track', '')}",
+            '\xa9ART': f"{info.get('artist', '')}",
+            '\xa9day': f"{info.get('release_year', '')}",
+            '\xa9gen': f"{info.get('genre', '')}",
+            '\xa9alb': f"{info.get('album', '')}",
+            '\xa9cmt': f'https://youtu.be/{info.get("id", "")}',
+        }
+        if isinstance(info.get('track_number'), int):
+            tags['trkn'] = [(info.get('track_number'), 0)]
+        audio.update(tags)
+        audio.save()
+
     def print_database(self):
         print('Songs in database:')
-        print(f'{"id":>3} | {"youtube_id":>13} | {"filename":>30} | {"telegram_id":>15} | {"duration":>9} | {"performer":>20} | {"title":>10} | {"thumbnail":>30}')
+        print(f'{"id":>3} | {"youtube_id":>13} | {"filename":>30} | {"telegram_id":>15} | {"duration":>9} | {"performer":>20} | {"title":>10} | {"thumbnail":>30} | {"telegram_unique_id":>20}')
         with self.ManagedSession() as session:
             for song in session.query(Music).order_by(Music.id):
-                print(f'{song.id:>3} | {song.youtube_id:>13} | {song.filename:>30} | {song.telegram_id:>15} | {song.duration:>9} | {song.performer:>20} | {song.title:>10} | {song.thumbnail:>30}')
+                # shared audio has no youtube_id, songs from youtube no telegram_unique_id
+                print(f'{song.id:>3} | {song.youtube_id or "":>13} | {song.filename:>30} | {song.telegram_id:>15} | {song.duration:>9} | {song.performer:>20} | {song.title:>10} | {song.thumbnail:>30} | {song.telegram_unique_id or "":>20}')
 
     def print_songs(self):
         print('Songs in database:')
@@ -158,9 +524,27 @@ class MusicDatabase():
             for song in session.query(Music).order_by(Music.id):
                 print(f'{song.id:>3} | {song.performer:>30} | {song.title:>20}')
 
-    def songs(self):
+    def songs(self, limit: int = None):
         with self.ManagedSession() as session:
-            return [music.to_dict() for music in session.query(Music).order_by(Music.id)]
+            if limit is None:
+                return [music.to_dict() for music in session.query(Music).order_by(Music.id)]
+            # most recent songs first
+            return [music.to_dict() for music in session.query(Music).order_by(Music.id.desc()).limit(limit)]
+
+    async def songs_async(self) -> list[dict]:
+        async with self.AsyncManagedSession() as session:
+            return [music.to_dict() for music in await session.scalars(select(Music).order_by(Music.id))]
+
+    def warm_cache(self):
+        songs = self.songs(limit=self.cache.maxsize)
+        # oldest first, so the most recent songs are evicted last
+        self.cache.put_many(reversed(songs))
+        self.logger.info(f'Song cache warmed with {len(songs)} songs')
+
+    def print_cache_stats(self):
+        print('Song cache:')
+        for key, value in self.cache.stats().items():
+            print(f'{key:>10} | {value}')
 
     def dump_info(self, info: dict):
         with open('./testings/info.json', 'w') as info_file:
@@ -1,56 +1,168 @@
-import os
-from time import sleep
-from yt_dlp import YoutubeDL
-from urllib.parse import urlparse
-from urllib.request import urlretrieve
+import re
+import threading
+from json import load
+from urllib.parse import urlparse, parse_qs
+from logging import getLogger, Logger
+
+from music.retry import RetryPolicy
+from music.transcoder import Transcoder, PROFILES
+from metrics.registry import registry
+
+# mp3 bitrates in kbps, best first
+QUALITIES = (320, 256, 192, 160, 128, 96, 64)
+
+YOUTUBE_ID = re.compile(r'[A-Za-z0-9_-]{11}')
+YOUTUBE_HOSTS = ('youtube.com', 'www.youtube.com', 'm.youtube.com', 'music.youtube.com')
+
+
+def video_id(url: str) -> str:
+    """ youtube_id of a single video link, None for playlists and anything else """
+    parsed = urlparse(url)
+    query = parse_qs(parsed.query)
+    if 'list' in query:
+        # listed as a playlist
+        return None
+    if parsed.hostname == 'youtu.be':
+        candidate = parsed.path.lstrip('/')
+    elif parsed.hostname in YOUTUBE_HOSTS and parsed.path == '/watch':
+        candidate = query.get('v', [''])[0]
+    elif parsed.hostname in YOUTUBE_HOSTS and parsed.path.startswith('/shorts/'):
+        candidate = parsed.path[len('/shorts/'):]
+    else:
+        return None
+    return candidate if YOUTUBE_ID.fullmatch(candidate) else None
+
+
+class AudioRejected(Exception):
+    """ Song does not fit the limits, nothing was downloaded """
+
+    def __init__(self, url: str, reason: str):
+        super().__init__(f'{url}: {reason}')
+        self.url = url
+        self.reason = reason
+
+    def __reduce__(self):
+        return (self.__class__, (self.url, self.reason))
 
 
 class MusicDownloader():
     def __init__(self):
-        pass
+        self.logger: Logger = getLogger(__name__)
+        self.retry_policy = RetryPolicy()
+        self.max_duration = 2 * 60 * 60
+        # telegram bot api upload limit
+        self.max_filesize = 50 * 1024 * 1024
+        self.quality = PROFILES['medium']
+        self.transcoder = Transcoder()
+        registry.counter('download_retries_total', 'Download attempts retried after backoff',
+                         function=lambda: self.retry_policy.retries)
+        registry.counter('download_failures_total', 'Downloads given up on',
+                         function=lambda: self.retry_policy.failures)
+        registry.counter('admission_rejected_total', 'Songs rejected by duration or size limits')
+
+    def load_settings(self, filename: str):
+        with open(filename, 'r') as settings:
+            settings = load(settings)
+        # {"max_attempts": 5, "base_delay": 2, "max_delay": 120, "jitter": 0.5}
+        self.retry_policy = RetryPolicy(**settings.get('retry', {}))
+        self.max_duration = settings.get('max_duration', self.max_duration)
+        self.max_filesize = settings.get('max_filesize', self.max_filesize)
+        # "low", "medium" or "high", see PROFILES
+        self.quality = PROFILES[settings.get('profile', 'medium')]
+        self.transcoder.shutdown()
+        self.transcoder = Transcoder(settings.get('transcode_workers'),
+                                     settings.get('ffmpeg', 'ffmpeg'),
+                                     settings.get('passthrough', True))
+
+    def shutdown(self):
+        self.transcoder.shutdown()
+
+    def youtube_dl(self, options: dict):
+        # yt_dlp takes a second or more to import, it is not needed to start the bot
+        from yt_dlp import YoutubeDL
+        return YoutubeDL(options)
+
+    def preload(self):
+        """ Import yt_dlp in the background once the bot is up, before the first request needs it """
+        threading.Thread(target=self.youtube_dl, args=({'quiet': True}, ), name='preload', daemon=True).start()
 
     def get_ydl_options(self, filename: str) -> dict:
         return {
             'quiet': True,
             'format': 'bestaudio/best',
-            'outtmpl': f'{filename}.%(ext)s',
+            # transcoder writes the final {filename}.mp3/.m4a
+            'outtmpl': f'{filename}.source.%(ext)s',
             'noplaylist': True,
-            'postprocessors': [{
-                'key': 'FFmpegExtractAudio',
-                'preferredcodec': 'mp3',
-                'preferredquality': '192'
-            }]
+            # keep .part files and continue them with range requests on retry
+            'continuedl': True,
+            'nopart': False,
+            'http_chunk_size': 10 * 1024 * 1024,
+            'retries': 3,
+            'fragment_retries': 3,
         }
 
-    def download_audio(self, info: dict, filename: str):
+    def download_audio(self, info: dict, filename: str) -> tuple[str, str]:
+        """ Download source audio as is, return its path and codec """
         ydl_opts = self.get_ydl_options(filename)
-        with YoutubeDL(ydl_opts) as ydl:
-            ydl.download([info.get('webpage_url')], )
-            return f'{filename}.mp3'
-
-    def verify_audio_parameters(self, info: dict):
-        duration = 10 * 60
-        filesize = 50 * 1024 * 1024
-        if info.get('duration', 0) > duration:
-            raise NameError(f'Audio duration exceed {duration} seconds.')
-        if info.get('filesize', 0) > filesize:
-            raise NameError(f'Audio filesize exceed {filesize} bytes.')
+        with self.youtube_dl(ydl_opts) as ydl, registry.stage('download').time():
+            result = ydl.extract_info(info.get('webpage_url'), download=True)
+            downloads = result.get('requested_downloads') or [{}]
+            source = downloads[0].get('filepath') or ydl.prepare_filename(result)
+            return source, result.get('acodec')
+
+    def admit(self, info: dict) -> int:
+        """ Check limits from extracted metadata, return mp3 bitrate that fits max_filesize """
+        url = info.get('webpage_url') or info.get('url')
+        duration = info.get('duration') or 0
+        if duration > self.max_duration:
+            self.reject()
+            raise AudioRejected(url, f'Audio duration {duration}sec exceeds {self.max_duration}sec.')
+        if not duration:
+            # no duration to estimate from, judge by the source size instead
+            filesize = info.get('filesize') or info.get('filesize_approx') or 0
+            if filesize > self.max_filesize:
+                self.reject()
+                raise AudioRejected(url, f'Audio filesize {filesize} bytes exceeds {self.max_filesize} bytes.')
+            return self.quality
+        for quality in QUALITIES:
+            # 2% headroom for tags and frame headers
+            if quality <= self.quality and duration * quality * 1000 / 8 * 1.02 <= self.max_filesize:
+                if quality != self.quality:
+                    self.logger.info(f'Lowering quality of {url} to {quality}kbps to fit upload limit')
+                return quality
+        self.reject()
+        raise AudioRejected(url, f'Audio of {duration}sec does not fit in {self.max_filesize} bytes.')
+
+    def reject(self):
+        registry.counter('admission_rejected_total').inc()
 
     def song(self, info: dict, filename: str):
-        # self.verify_audio_parameters(info)
-        while True:
-            try:
-                return self.download_audio(info, filename)
-            except Exception as err:
-                print(f'{err}\n{info.get("webpage_url")}')
-                sleep(10)
-
-    def retrive_songs_info(self, url: str) -> list[dict]:
-        info = YoutubeDL({'quiet': True}).extract_info(url, download=False)
+        quality = self.admit(info)
+        # a failed transcode is retried and dead-lettered like a failed download
+        return self.retry_policy.call(info.get('webpage_url'), self.fetch, info, filename, quality)
+
+    def fetch(self, info: dict, filename: str, quality: int) -> str:
+        source, acodec = self.download_audio(info, filename)
+        return self.transcoder.transcode(source, filename, acodec, quality, self.max_filesize)
+
+    def retrive_entries(self, url: str) -> list[dict]:
+        # playlist entries come back as flat stubs (id, url, title) without formats
+        with registry.stage('extract').time():
+            info = self.retry_policy.call(url, self.extract_flat, url)
         if info.get('_type') == 'playlist':
             return [entry for entry in info.get('entries') if entry is not None]
         return [info, ]
 
-    def thumb(self, url: str, filename: str) -> str:
-        _, ext = os.path.splitext(os.path.normpath(urlparse(url).path))
-        return urlretrieve(url, f'{filename}{ext}')[0]
+    def extract_flat(self, url: str) -> dict:
+        return self.youtube_dl({'quiet': True, 'extract_flat': 'in_playlist'}).extract_info(url, download=False)
+
+    def resolve_info(self, entry: dict) -> dict:
+        if entry.get('_type') == 'url':
+            # flat entries usually carry duration already, reject before resolving formats
+            self.admit(entry)
+            return self.retry_policy.call(entry.get('url'), self.extract_info, entry.get('url'))
+        return entry
+
+    def extract_info(self, url: str) -> dict:
+        with registry.stage('extract').time():
+            return self.youtube_dl({'quiet': True}).extract_info(url, download=False)
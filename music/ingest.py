@@ -0,0 +1,60 @@
+import asyncio
+from logging import getLogger, Logger
+
+from music.database import MusicDatabase
+
+
+class AudioIngest():
+    """ Records audio shared with the bot in batches.
+
+    Handlers only queue the downloaded file; tags are read with mutagen and
+    rows inserted for a whole batch at once, off the event loop.
+    """
+
+    def __init__(self, music_database: MusicDatabase, batch_size: int = 20, delay: float = 2.0):
+        self.logger: Logger = getLogger(__name__)
+        self.music_database = music_database
+        self.batch_size = batch_size
+        # seconds a lone song waits for company before its batch is flushed
+        self.delay = delay
+        self.pending: list[dict] = []
+        self.timer: asyncio.TimerHandle = None
+        # flush started by the timer, referenced so it is not garbage collected
+        self.task: asyncio.Task = None
+        # one batch at a time, a re-share in the next batch then finds the song recorded
+        self.lock = asyncio.Lock()
+        # telegram_unique_ids of batches taken from pending but not inserted yet
+        self.recording: set[str] = set()
+
+    def queued(self, telegram_unique_id: str) -> bool:
+        return (telegram_unique_id in self.recording or
+                any(item.get('telegram_unique_id') == telegram_unique_id for item in self.pending))
+
+    async def submit(self, item: dict) -> None:
+        self.pending.append(item)
+        if len(self.pending) >= self.batch_size:
+            await self.flush()
+        elif self.timer is None:
+            loop = asyncio.get_running_loop()
+            self.timer = loop.call_later(self.delay, self.flush_later)
+
+    def flush_later(self) -> None:
+        self.timer = None
+        self.task = asyncio.get_running_loop().create_task(self.flush())
+
+    async def flush(self) -> None:
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        batch, self.pending = self.pending, []
+        if not batch:
+            return
+        unique_ids = {item.get('telegram_unique_id') for item in batch}
+        self.recording.update(unique_ids)
+        try:
+            async with self.lock:
+                await asyncio.get_running_loop().run_in_executor(None, self.music_database.ingest_songs, batch)
+        except Exception:
+            self.logger.exception(f'Failed to record {len(batch)} shared songs')
+        finally:
+            self.recording.difference_update(unique_ids)
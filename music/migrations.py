@@ -0,0 +1,46 @@
+from logging import getLogger
+from sqlalchemy import inspect, text
+
+from music.music import Music
+
+logger = getLogger(__name__)
+
+
+def add_missing_columns(engine):
+    """ New model columns on tables created before them; indexes are created afterwards """
+    existing = {column['name'] for column in inspect(engine).get_columns(Music.__tablename__)}
+    with engine.begin() as connection:
+        for column in Music.__table__.columns:
+            if column.name not in existing:
+                logger.info(f'Adding column music.{column.name}')
+                connection.execute(text(f'ALTER TABLE music ADD COLUMN {column.name} {column.type.compile(engine.dialect)}'))
+
+
+def drop_unique_filename(engine):
+    """ Files are content addressed now, songs with identical audio share one filename """
+    inspector = inspect(engine)
+    constraints = [constraint for constraint in inspector.get_unique_constraints(Music.__tablename__)
+                   if constraint.get('column_names') == ['filename']]
+    if not constraints:
+        return
+    logger.info('Dropping unique constraint on music.filename')
+    if engine.dialect.name != 'sqlite':
+        with engine.begin() as connection:
+            for constraint in constraints:
+                connection.execute(text(f'ALTER TABLE music DROP CONSTRAINT {constraint["name"]}'))
+        return
+    # sqlite cannot drop a constraint, copy rows into a table created from the model
+    columns = ', '.join(column['name'] for column in inspector.get_columns(Music.__tablename__)
+                        if column['name'] in Music.__table__.columns)
+    with engine.begin() as connection:
+        for index in inspector.get_indexes(Music.__tablename__):
+            connection.execute(text(f'DROP INDEX {index["name"]}'))
+        connection.execute(text('ALTER TABLE music RENAME TO music_old'))
+        Music.__table__.create(connection)
+        connection.execute(text(f'INSERT INTO music ({columns}) SELECT {columns} FROM music_old'))
+        connection.execute(text('DROP TABLE music_old'))
+
+
+def migrate(engine):
+    add_missing_columns(engine)
+    drop_unique_filename(engine)
@@ -1,4 +1,5 @@
-from sqlalchemy import Column, Integer, String
+from datetime import datetime
+from sqlalchemy import Column, Integer, String, DateTime
 from sqlalchemy.ext.declarative import declarative_base
 
 Base = declarative_base()
@@ -8,24 +9,76 @@ class Music(Base):
     __tablename__ = 'music'
 
     id = Column(Integer, primary_key=True, autoincrement=True)
+    # empty for audio shared with the bot, those are keyed by telegram_unique_id
     youtube_id = Column(String, unique=True)
-    filename = Column(String, unique=True)
-    telegram_id = Column(String)
+    # content addressed, songs with identical audio share the file
+    filename = Column(String)
+    telegram_id = Column(String, index=True)
     duration = Column(Integer, )
     performer = Column(String)
     title = Column(String)
     thumbnail = Column(String)
+    telegram_unique_id = Column(String, unique=True, index=True)
 
     def __repr__(self) -> str:
-        return f'<Music(id={self.id}, youtube_id={self.youtube_id}, filename={self.filename}, telegram_id={self.telegram_id}, duration={self.duration}, performer={self.performer}, title={self.title}, thumbnail={self.thumbnail})>'
+        return f'<Music(id={self.id}, youtube_id={self.youtube_id}, filename={self.filename}, telegram_id={self.telegram_id}, duration={self.duration}, performer={self.performer}, title={self.title}, thumbnail={self.thumbnail}, telegram_unique_id={self.telegram_unique_id})>'
 
     def to_dict(self) -> dict:
         return {
-            'youtube_id': str(self.youtube_id),
+            'youtube_id': str(self.youtube_id or ''),
             'filename': str(self.filename),
             'telegram_id': str(self.telegram_id),
             'duration': int(self.duration),
             'performer': str(self.performer),
             'title': str(self.title),
-            'thumbnail': str(self.thumbnail)
+            'thumbnail': str(self.thumbnail),
+            'telegram_unique_id': str(self.telegram_unique_id or '')
         }
+
+
+# job stages, a job row is deleted once its track is sent
+JOB_LISTING = 'listing'
+JOB_QUEUED = 'queued'
+JOB_DOWNLOADED = 'downloaded'
+
+
+class Job(Base):
+    """ A /music request not sent yet: a url to list, then one row per track """
+    __tablename__ = 'jobs'
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    chat_id = Column(Integer, index=True)
+    url = Column(String)
+    youtube_id = Column(String, index=True)
+    stage = Column(String)
+    # startups that resumed the job, poison requests are dropped after a few
+    attempts = Column(Integer, default=0)
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+    def __repr__(self) -> str:
+        return f'<Job(id={self.id}, chat_id={self.chat_id}, url={self.url}, youtube_id={self.youtube_id}, stage={self.stage}, attempts={self.attempts}, updated_at={self.updated_at})>'
+
+    def to_dict(self) -> dict:
+        return {
+            'id': self.id,
+            'chat_id': self.chat_id,
+            'url': self.url,
+            'youtube_id': self.youtube_id,
+            'stage': self.stage,
+        }
+
+
+class DeadLetter(Base):
+    """ Songs given up on after retries, kept for inspection """
+    __tablename__ = 'dead_letters'
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    youtube_id = Column(String)
+    url = Column(String)
+    error = Column(String)
+    attempts = Column(Integer)
+    permanent = Column(Integer)
+    failed_at = Column(DateTime, default=datetime.utcnow)
+
+    def __repr__(self) -> str:
+        return f'<DeadLetter(id={self.id}, youtube_id={self.youtube_id}, url={self.url}, error={self.error}, attempts={self.attempts}, permanent={self.permanent}, failed_at={self.failed_at})>'
@@ -0,0 +1,82 @@
+import random
+import threading
+from time import sleep
+from logging import getLogger, Logger
+
+# lower-cased fragments of yt-dlp messages that no retry will fix
+PERMANENT_ERRORS = (
+    'video unavailable',
+    'private video',
+    'has been removed',
+    'account associated with this video has been terminated',
+    'not available in your country',
+    'sign in to confirm your age',
+    'members-only',
+    'copyright',
+    'unsupported url',
+    'is not a valid url',
+    'this live event will begin',
+)
+
+
+class DownloadFailed(Exception):
+    def __init__(self, url: str, reason: str, attempts: int, permanent: bool):
+        super().__init__(f'{url}: {reason}')
+        self.url = url
+        self.reason = reason
+        self.attempts = attempts
+        self.permanent = permanent
+
+    def __reduce__(self):
+        # pickled back from download worker processes
+        return (self.__class__, (self.url, self.reason, self.attempts, self.permanent))
+
+
+class RetryPolicy():
+    """ Exponential backoff with jitter and a cap on attempts.
+
+    Runs on download workers, so sleeping here holds only one worker.
+    """
+
+    def __init__(self, max_attempts: int = 5, base_delay: float = 2, max_delay: float = 120, jitter: float = 0.5):
+        self.logger: Logger = getLogger(__name__)
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.jitter = jitter
+        self.lock = threading.Lock()
+        self.retries = 0
+        self.failures = 0
+
+    def delay(self, attempt: int) -> float:
+        delay = min(self.max_delay, self.base_delay * 2 ** (attempt - 1))
+        return random.uniform(delay * (1 - self.jitter), delay)
+
+    def is_permanent(self, err: Exception) -> bool:
+        # DownloadError wraps the extractor error which knows if it was expected
+        cause = err.exc_info[1] if getattr(err, 'exc_info', None) else err
+        if getattr(cause, 'expected', False):
+            return True
+        message = str(err).lower()
+        return any(fragment in message for fragment in PERMANENT_ERRORS)
+
+    def call(self, url: str, fn, *args):
+        for attempt in range(1, self.max_attempts + 1):
+            try:
+                return fn(*args)
+            except Exception as err:
+                permanent = self.is_permanent(err)
+                if permanent or attempt == self.max_attempts:
+                    with self.lock:
+                        self.failures += 1
+                    self.logger.error(f'Giving up on {url} after {attempt} attempts: {err}')
+                    raise DownloadFailed(url, str(err), attempt, permanent) from err
+                delay = self.delay(attempt)
+                with self.lock:
+                    self.retries += 1
+                self.logger.warning(f'Attempt {attempt} for {url} failed, retrying in {delay:.1f}sec: {err}')
+                sleep(delay)
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {'retries': self.retries, 'failures': self.failures}
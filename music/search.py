@@ -0,0 +1,57 @@
+import re
+from sqlalchemy import text, inspect, or_, and_
+from sqlalchemy.sql import select, table, column
+
+from music.music import Music
+
+# external content table over music(performer, title), kept in sync by triggers
+FTS_STATEMENTS = (
+    "CREATE VIRTUAL TABLE IF NOT EXISTS music_fts USING fts5("
+    "performer, title, content='music', content_rowid='id', tokenize='unicode61 remove_diacritics 2')",
+    "CREATE TRIGGER IF NOT EXISTS music_fts_insert AFTER INSERT ON music BEGIN "
+    "INSERT INTO music_fts(rowid, performer, title) VALUES (new.id, new.performer, new.title); END",
+    "CREATE TRIGGER IF NOT EXISTS music_fts_delete AFTER DELETE ON music BEGIN "
+    "INSERT INTO music_fts(music_fts, rowid, performer, title) VALUES ('delete', old.id, old.performer, old.title); END",
+    "CREATE TRIGGER IF NOT EXISTS music_fts_update AFTER UPDATE OF performer, title ON music BEGIN "
+    "INSERT INTO music_fts(music_fts, rowid, performer, title) VALUES ('delete', old.id, old.performer, old.title); "
+    "INSERT INTO music_fts(rowid, performer, title) VALUES (new.id, new.performer, new.title); END",
+)
+
+music_fts = table('music_fts', column('rowid'), column('rank'))
+
+
+class SearchIndex():
+    """ Full-text search over performer/title: FTS5 on SQLite, LIKE elsewhere """
+
+    def __init__(self, engine):
+        self.fts = engine.dialect.name == 'sqlite'
+        self.engine = engine
+
+    def create(self):
+        if not self.fts:
+            return
+        existed = inspect(self.engine).has_table('music_fts')
+        with self.engine.begin() as connection:
+            for statement in FTS_STATEMENTS:
+                connection.execute(text(statement))
+            if not existed:
+                # index songs recorded before the search existed
+                connection.execute(text("INSERT INTO music_fts(music_fts) VALUES ('rebuild')"))
+
+    def words(self, query: str) -> list[str]:
+        return re.findall(r'\w+', query.lower())
+
+    def statement(self, query: str, limit: int):
+        """ Songs already on telegram matching every word of query, best first """
+        words = self.words(query)
+        if not words:
+            return None
+        statement = select(Music).where(Music.telegram_id != '').limit(limit)
+        if self.fts:
+            # every word as a quoted prefix term, so user input is never FTS syntax
+            match = ' '.join(f'"{word}"*' for word in words)
+            return (statement.join(music_fts, music_fts.c.rowid == Music.id).
+                    where(text('music_fts MATCH :match').bindparams(match=match)).
+                    order_by(music_fts.c.rank))
+        return statement.where(and_(*(or_(Music.performer.ilike(f'%{word}%'), Music.title.ilike(f'%{word}%'))
+                                      for word in words))).order_by(Music.id.desc())
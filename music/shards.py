@@ -0,0 +1,120 @@
+import os
+import zlib
+import logging
+import logging.handlers
+import multiprocessing
+from json import load
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from music.workers import DownloadPool
+from music.downloader import MusicDownloader
+from music.database import MusicDatabase
+from music.cache import SongCache
+from music.transcoder import Transcoder
+from metrics.registry import registry
+from lazyuselessbot.logs import ProcessQueueHandler, RelogHandler
+
+# MusicDatabase of this worker process, built by init_worker
+database: MusicDatabase = None
+# registry state sent to the front process so far
+metrics_sent: dict = {}
+
+
+def init_worker(music_settings: str, processes: int, log_queue: multiprocessing.Queue):
+    """ Runs once in every worker process: its own downloader, engine and thumbnail loop """
+    global database
+    # records go to the front process and its log file
+    logger = logging.getLogger()
+    logger.setLevel(logging.INFO)
+    logger.addHandler(ProcessQueueHandler(log_queue))
+    downloader = MusicDownloader()
+    downloader.load_settings(music_settings)
+    with open(music_settings, 'r') as settings:
+        transcode_workers = load(settings).get('transcode_workers')
+    if not transcode_workers:
+        # the shards share the cores instead of each taking all of them
+        downloader.transcoder.shutdown()
+        downloader.transcoder = Transcoder(max(1, (os.cpu_count() or 1) // processes),
+                                           downloader.transcoder.ffmpeg,
+                                           downloader.transcoder.passthrough)
+    database = MusicDatabase(downloader)
+    database.load_settings(music_settings)
+    # telegram ids are recorded by the front process, records cached here would go stale
+    database.cache = SongCache(ttl=0)
+    for name in ('cache_hits_total', 'cache_misses_total', 'cache_size'):
+        registry.remove(name)
+    database.connect()
+
+
+def run_job(name: str, args: tuple) -> tuple:
+    """ Result or error of the job, with the metrics it recorded for the front registry """
+    global metrics_sent
+    result, error = None, None
+    try:
+        result = getattr(database, name)(*args)
+    except Exception as err:
+        error = err
+    changes, metrics_sent = registry.changes(metrics_sent)
+    return result, error, changes
+
+
+class ShardedDownloadPool(DownloadPool):
+    """ DownloadPool whose jobs run in worker processes instead of threads.
+
+    Threads here keep the per-chat round-robin and single-flight of the pool
+    and only wait for a process. A job goes to the process picked by its key
+    (youtube_id), or chat_id without one, so a song always lands on the same
+    shard. Jobs are MusicDatabase methods, called on the process's own instance.
+    """
+
+    def __init__(self, processes: int, music_settings: str):
+        super().__init__()
+        self.processes = processes
+        self.music_settings = music_settings
+        self.shards: list[ProcessPoolExecutor] = []
+        self.context = multiprocessing.get_context('spawn')
+        self.log_queue = self.context.Queue()
+        self.log_listener = logging.handlers.QueueListener(self.log_queue, RelogHandler())
+
+    def executor(self) -> ProcessPoolExecutor:
+        # forking a process full of threads is unsafe, workers start a fresh interpreter
+        return ProcessPoolExecutor(max_workers=1,
+                                   mp_context=self.context,
+                                   initializer=init_worker,
+                                   initargs=(self.music_settings, self.processes, self.log_queue))
+
+    def start(self):
+        self.log_listener.start()
+        self.shards = [self.executor() for _ in range(self.processes)]
+        # a thread per shard at least, extra threads queue in front of busy shards
+        self.max_workers = max(self.max_workers, self.processes)
+        super().start()
+        self.logger.info(f'Download jobs sharded over {self.processes} worker processes')
+
+    def shard(self, chat_id: int, key: str) -> int:
+        # crc32 is the same in every process and run, hash() of a str is not
+        return (zlib.crc32(key.encode()) if key else chat_id) % len(self.shards)
+
+    def call(self, chat_id: int, key: str, fn, args: tuple):
+        index = self.shard(chat_id, key)
+        shard = self.shards[index]
+        try:
+            result, error, changes = shard.submit(run_job, fn.__name__, args).result()
+        except BrokenProcessPool:
+            # the process died mid-job, later jobs of the shard get a new one
+            with self.condition:
+                if self.shards[index] is shard:
+                    self.logger.error(f'Worker process of shard {index} died, restarting it')
+                    self.shards[index] = self.executor()
+            raise
+        registry.merge(changes)
+        if error is not None:
+            raise error
+        return result
+
+    def shutdown(self, wait: bool = True):
+        super().shutdown(wait)
+        for shard in self.shards:
+            shard.shutdown(wait=wait, cancel_futures=True)
+        self.log_listener.stop()
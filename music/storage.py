@@ -0,0 +1,118 @@
+import os
+import threading
+from hashlib import sha256
+from collections import Counter, OrderedDict
+from logging import getLogger, Logger
+
+
+class AudioStorage():
+    """ Audio files named by the sha256 of their content under songs_path/ab/abcd...ext.
+
+    Identical audio is stored once. Files of songs not on telegram yet are
+    pinned; the rest are evicted least recently used first whenever the
+    total size goes over the disk budget.
+    """
+
+    def __init__(self, songs_path: str, budget: int = None):
+        self.logger: Logger = getLogger(__name__)
+        self.songs_path = songs_path
+        # bytes, None keeps everything
+        self.budget = budget
+        self.lock = threading.Lock()
+        self.sizes: dict[str, int] = {}
+        # path → number of songs using it that still need the local file
+        self.pins: Counter = Counter()
+        # evictable paths, least recently used first
+        self.released: OrderedDict[str, None] = OrderedDict()
+        self.size = 0
+
+    def digest(self, filename: str) -> str:
+        digest = sha256()
+        with open(filename, 'rb') as audio:
+            while chunk := audio.read(1024 * 1024):
+                digest.update(chunk)
+        return digest.hexdigest()
+
+    def path(self, digest: str, ext: str) -> str:
+        return os.path.join(self.songs_path, digest[:2], f'{digest}{ext}')
+
+    def temporary(self, name: str) -> str:
+        """ Where a download of `name` is written before it is stored """
+        os.makedirs(os.path.join(self.songs_path, 'tmp'), exist_ok=True)
+        return os.path.join(self.songs_path, 'tmp', name)
+
+    def store(self, source: str) -> tuple[str, bool]:
+        """ Move source into storage, return its path and whether it was new """
+        path = self.path(self.digest(source), os.path.splitext(source)[1])
+        with self.lock:
+            created = not os.path.exists(path)
+            if created:
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                os.replace(source, path)
+                self.sizes[path] = os.path.getsize(path)
+                self.size += self.sizes[path]
+            else:
+                os.remove(source)
+                self.logger.info(f'Deduplicated {os.path.basename(path)}')
+            self.pins[path] += 1
+            self.released.pop(path, None)
+        return path, created
+
+    def release(self, paths: list[str]) -> list[str]:
+        """ Songs got their telegram_id, their files may go; return evicted paths """
+        with self.lock:
+            for path in paths:
+                if path not in self.sizes and self.exists(path):
+                    # stored by a download worker process, first seen here
+                    self.sizes[path] = os.path.getsize(path)
+                    self.size += self.sizes[path]
+                if self.pins[path] > 0:
+                    self.pins[path] -= 1
+                if self.pins[path] <= 0 and path in self.sizes:
+                    self.pins.pop(path, None)
+                    self.released[path] = None
+                    self.released.move_to_end(path)
+            return self.evict()
+
+    def touch(self, path: str):
+        with self.lock:
+            if path in self.released:
+                self.released.move_to_end(path)
+
+    def evict(self) -> list[str]:
+        evicted = []
+        while self.budget is not None and self.size > self.budget and self.released:
+            path, _ = self.released.popitem(last=False)
+            self.size -= self.sizes.pop(path)
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            evicted.append(path)
+        if evicted:
+            self.logger.info(f'Evicted {len(evicted)} local songs, {self.size} bytes kept')
+        return evicted
+
+    def exists(self, path: str) -> bool:
+        return bool(path) and os.path.exists(path)
+
+    def scan(self, songs: list[dict]) -> list[str]:
+        """ Rebuild state from library records at startup, oldest files evicted first """
+        files = []
+        with self.lock:
+            for song in songs:
+                path = song.get('filename')
+                if not self.exists(path):
+                    continue
+                if path not in self.sizes:
+                    stat = os.stat(path)
+                    self.sizes[path] = stat.st_size
+                    self.size += stat.st_size
+                if song.get('telegram_id'):
+                    files.append((os.stat(path).st_mtime, path))
+                else:
+                    self.pins[path] += 1
+            for _, path in sorted(files):
+                if path not in self.pins:
+                    self.released[path] = None
+            return self.evict()
@@ -0,0 +1,88 @@
+import os
+import asyncio
+import httpx
+import tempfile
+import threading
+from hashlib import sha256
+from cachetools import LRUCache
+from concurrent.futures import Future
+from logging import getLogger, Logger
+
+from metrics.registry import registry
+
+# telegram rejects thumbnails above 320px per side or 200 kB
+MAX_THUMBNAIL_SIDE = 320
+MAX_THUMBNAIL_SIZE = 200 * 1024
+# ffmpeg -q:v values to try, best jpeg quality first
+JPEG_QUALITIES = (2, 5, 10, 20, 31)
+
+
+class ThumbnailFetcher():
+    """ Fetches thumbnails on one pooled httpx client running in a loop of its own.
+
+    Files are named by the hash of the downloaded image, so the same cover
+    shared by a whole album is stored and resized only once.
+    """
+
+    def __init__(self, thumbnails_path: str, ffmpeg: str = 'ffmpeg', max_connections: int = 10):
+        self.logger: Logger = getLogger(__name__)
+        self.thumbnails_path = thumbnails_path
+        self.ffmpeg = ffmpeg
+        self.max_connections = max_connections
+        # url → stored thumbnail, skips the request for covers seen before
+        self.urls: LRUCache = LRUCache(maxsize=4096)
+
+    def start(self):
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, name='thumbnails', daemon=True)
+        self.thread.start()
+        self.client: httpx.AsyncClient = asyncio.run_coroutine_threadsafe(self.create_client(), self.loop).result()
+
+    async def create_client(self) -> httpx.AsyncClient:
+        return httpx.AsyncClient(limits=httpx.Limits(max_connections=self.max_connections,
+                                                     max_keepalive_connections=self.max_connections),
+                                 timeout=30,
+                                 follow_redirects=True)
+
+    def fetch(self, url: str) -> Future:
+        """ Start fetching from any thread, the future resolves to the stored path """
+        return asyncio.run_coroutine_threadsafe(self.fetch_async(url), self.loop)
+
+    async def fetch_async(self, url: str) -> str:
+        if url in self.urls:
+            return self.urls[url]
+        with registry.stage('thumbnail').time():
+            response = await self.client.get(url)
+            response.raise_for_status()
+            path = os.path.join(self.thumbnails_path, f'{sha256(response.content).hexdigest()}.jpg')
+            if not os.path.exists(path):
+                await self.resize(response.content, path)
+        self.urls[url] = path
+        return path
+
+    async def resize(self, content: bytes, path: str):
+        fd, temp = tempfile.mkstemp(suffix='.jpg', dir=self.thumbnails_path)
+        os.close(fd)
+        try:
+            for quality in JPEG_QUALITIES:
+                process = await asyncio.create_subprocess_exec(
+                    self.ffmpeg, '-y', '-loglevel', 'error', '-i', 'pipe:0',
+                    '-vf', f"scale=w='min({MAX_THUMBNAIL_SIDE},iw)':h='min({MAX_THUMBNAIL_SIDE},ih)':force_original_aspect_ratio=decrease",
+                    '-q:v', f'{quality}', '-frames:v', '1', '-f', 'image2', temp,
+                    stdin=asyncio.subprocess.PIPE,
+                    stdout=asyncio.subprocess.DEVNULL,
+                    stderr=asyncio.subprocess.PIPE)
+                _, error = await process.communicate(content)
+                if process.returncode != 0:
+                    raise RuntimeError(f'ffmpeg failed to resize thumbnail: {error.decode(errors="ignore")}')
+                if os.path.getsize(temp) <= MAX_THUMBNAIL_SIZE:
+                    break
+            os.replace(temp, path)
+        finally:
+            if os.path.exists(temp):
+                os.remove(temp)
+
+    def close(self):
+        asyncio.run_coroutine_threadsafe(self.client.aclose(), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
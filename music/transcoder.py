@@ -0,0 +1,92 @@
+import os
+import threading
+import subprocess
+from time import monotonic
+from logging import getLogger, Logger
+from concurrent.futures import ThreadPoolExecutor
+
+from metrics.registry import registry
+
+# quality profile → mp3 bitrate in kbps
+PROFILES = {
+    'low': 128,
+    'medium': 192,
+    'high': 320,
+}
+
+# sendAudio accepts mp3 and m4a, sources in these codecs are remuxed as is
+PASSTHROUGH = {
+    'mp3': 'mp3',
+    'mp4a': 'm4a',
+    'aac': 'm4a',
+}
+
+
+class Transcoder():
+    """ ffmpeg stage run next to downloads, at most one encoder per CPU core.
+
+    ffmpeg is a process of its own, so a thread only waits for it; the pool
+    size is what keeps encoders from oversubscribing the cores.
+    """
+
+    def __init__(self, workers: int = None, ffmpeg: str = 'ffmpeg', passthrough: bool = True, timeout: float = 15 * 60):
+        self.logger: Logger = getLogger(__name__)
+        self.workers = workers or os.cpu_count() or 1
+        self.ffmpeg = ffmpeg
+        self.passthrough = passthrough
+        self.timeout = timeout
+        self.executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='transcode')
+        self.lock = threading.Lock()
+        self.jobs = 0
+        self.copied = 0
+        self.seconds = 0.0
+
+    def container(self, acodec: str) -> str:
+        if not self.passthrough or not acodec:
+            return None
+        return PASSTHROUGH.get(acodec.split('.')[0].lower())
+
+    def transcode(self, source: str, filename: str, acodec: str, quality: int, max_filesize: int) -> str:
+        """ Turn downloaded source into {filename}.mp3 or .m4a, return the new path """
+        return self.executor.submit(self.run, source, filename, acodec, quality, max_filesize).result()
+
+    def run(self, source: str, filename: str, acodec: str, quality: int, max_filesize: int) -> str:
+        start = monotonic()
+        container = self.container(acodec)
+        if container and os.path.getsize(source) <= max_filesize:
+            target = f'{filename}.{container}'
+            codec = ['-c:a', 'copy']
+        else:
+            container = None
+            target = f'{filename}.mp3'
+            codec = ['-c:a', 'libmp3lame', '-b:a', f'{quality}k']
+        try:
+            subprocess.run([self.ffmpeg, '-y', '-loglevel', 'error', '-i', source, '-vn', '-map_metadata', '-1', *codec, target],
+                           check=True, capture_output=True, timeout=self.timeout)
+        except subprocess.CalledProcessError as err:
+            raise RuntimeError(f'ffmpeg failed to transcode: {err.stderr.decode(errors="ignore").strip()}') from err
+        finally:
+            # a retry downloads the source again
+            if os.path.abspath(source) != os.path.abspath(target) and os.path.exists(source):
+                os.remove(source)
+
+        elapsed = monotonic() - start
+        with self.lock:
+            self.jobs += 1
+            self.copied += bool(container)
+            self.seconds += elapsed
+        registry.stage('copy' if container else 'transcode').observe(elapsed)
+        self.logger.info(f'{"Copied" if container else "Transcoded"} {os.path.basename(target)} in {elapsed:.1f}sec')
+        return target
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                'workers': self.workers,
+                'jobs': self.jobs,
+                'copied': self.copied,
+                'seconds': round(self.seconds, 3),
+            }
+
+    def shutdown(self):
+        self.executor.shutdown(wait=True)
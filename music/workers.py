@@ -0,0 +1,196 @@
+import asyncio
+import threading
+from json import load
+from collections import deque
+from concurrent.futures import Future, InvalidStateError
+from logging import getLogger, Logger
+
+from metrics.registry import registry
+
+
+class Flight():
+    """ One queued job shared by every caller that asked for the same key.
+
+    Each caller gets its own future, so one caller giving up does not cancel
+    the job for the others; the job is cancelled only when all of them leave.
+    """
+
+    def __init__(self, job: Future):
+        self.job = job
+        self.callers = 0
+        self.lock = threading.Lock()
+
+    def join(self) -> Future:
+        caller = Future()
+        with self.lock:
+            self.callers += 1
+        caller.add_done_callback(self.leave)
+        self.job.add_done_callback(lambda job: self.resolve(caller, job))
+        return caller
+
+    def resolve(self, caller: Future, job: Future):
+        try:
+            if job.cancelled():
+                caller.cancel()
+            elif job.exception() is not None:
+                caller.set_exception(job.exception())
+            else:
+                caller.set_result(job.result())
+        except InvalidStateError:
+            # caller was cancelled meanwhile
+            pass
+
+    def leave(self, caller: Future):
+        if caller.cancelled():
+            with self.lock:
+                self.callers -= 1
+                last = self.callers == 0
+            if last:
+                self.job.cancel()
+
+
+class DownloadPool():
+    """ Bounded pool of worker threads for yt-dlp/ffmpeg jobs.
+
+    Jobs are queued per chat and picked round-robin, so one long playlist
+    does not starve other chats waiting for a single song.
+    """
+
+    def __init__(self):
+        self.logger: Logger = getLogger(__name__)
+        self.max_workers = 4
+        # downloads allowed to run ahead of the track being uploaded
+        self.prefetch = 2
+        # chat_id → deque of (future, fn, args, key); dict order is round-robin order
+        self.queues: dict[int, deque] = {}
+        # (function name, key) → job already queued or running for it
+        self.flights: dict[tuple[str, str], Flight] = {}
+        self.condition = threading.Condition()
+        self.threads: list[threading.Thread] = []
+        self.running = False
+
+    def load_settings(self, filename: str):
+        with open(filename, 'r') as settings:
+            settings = load(settings)
+        self.max_workers = settings.get('download_workers', self.max_workers)
+        self.prefetch = settings.get('download_prefetch', self.prefetch)
+
+    def start(self):
+        self.running = True
+        for index in range(self.max_workers):
+            thread = threading.Thread(target=self.worker,
+                                      name=f'download-worker-{index}',
+                                      daemon=True)
+            thread.start()
+            self.threads.append(thread)
+        registry.gauge('download_queue_depth', 'Jobs waiting for a download worker', function=self.pending)
+        registry.gauge('download_inflight_keys', 'Distinct songs queued or downloading', function=lambda: len(self.flights))
+        self.logger.info(f'Download pool started with {self.max_workers} workers')
+
+    def submit(self, chat_id: int, fn, *args, key: str = None) -> Future:
+        """ Queue fn(*args); callers passing the same key share a single run """
+        with self.condition:
+            if not self.running:
+                raise RuntimeError('Download pool is not running')
+            if key is None:
+                return self.enqueue(chat_id, fn, args)
+            # a refetch of a song must not join its get_song, only the same call is shared
+            flight_key = (fn.__name__, key)
+            flight = self.flights.get(flight_key)
+            if flight is None:
+                flight = self.flights[flight_key] = Flight(self.enqueue(chat_id, fn, args, key))
+                flight.job.add_done_callback(lambda job: self.land(flight_key, flight))
+            else:
+                self.logger.info(f'Joined in-flight job for {key}')
+            return flight.join()
+
+    def enqueue(self, chat_id: int, fn, args: tuple, key: str = None) -> Future:
+        future = Future()
+        self.queues.setdefault(chat_id, deque()).append((future, fn, args, key))
+        self.condition.notify()
+        return future
+
+    def land(self, key: tuple[str, str], flight: Flight):
+        with self.condition:
+            if self.flights.get(key) is flight:
+                del self.flights[key]
+
+    async def run(self, chat_id: int, fn, *args, key: str = None):
+        return await asyncio.wrap_future(self.submit(chat_id, fn, *args, key=key))
+
+    async def map(self, chat_id: int, fn, iterable, prefetch: int = None, key=None,
+                  return_exceptions: bool = False):
+        """ Apply fn to every item on the pool, yield results in order as they finish.
+
+        At most `prefetch` items are downloading ahead of the one being consumed,
+        so memory and disk stay flat however long the iterable is.
+        `key(item)` gives the single-flight key of an item, see submit.
+        With `return_exceptions` a failed item is yielded as its exception.
+        """
+        prefetch = self.prefetch if prefetch is None else prefetch
+        pending: deque[asyncio.Future] = deque()
+        try:
+            for item in iterable:
+                future = self.submit(chat_id, fn, item, key=key(item) if key else None)
+                pending.append(asyncio.wrap_future(future))
+                if len(pending) > prefetch:
+                    yield await self.result(pending.popleft(), return_exceptions)
+            while pending:
+                yield await self.result(pending.popleft(), return_exceptions)
+        finally:
+            for future in pending:
+                future.cancel()
+
+    async def result(self, future: asyncio.Future, return_exceptions: bool):
+        try:
+            return await future
+        except Exception as err:
+            if return_exceptions:
+                return err
+            raise
+
+    def pending(self) -> int:
+        with self.condition:
+            return sum(len(queue) for queue in self.queues.values())
+
+    def next_job(self):
+        with self.condition:
+            while self.running and not self.queues:
+                self.condition.wait()
+            if not self.queues:
+                return None
+            # take from the chat at the head and move it to the tail
+            chat_id = next(iter(self.queues))
+            queue = self.queues.pop(chat_id)
+            job = queue.popleft()
+            if queue:
+                self.queues[chat_id] = queue
+            return chat_id, job
+
+    def call(self, chat_id: int, key: str, fn, args: tuple):
+        return fn(*args)
+
+    def worker(self):
+        while (job := self.next_job()) is not None:
+            chat_id, (future, fn, args, key) = job
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                result = self.call(chat_id, key, fn, args)
+            except BaseException as err:
+                future.set_exception(err)
+            else:
+                future.set_result(result)
+
+    def shutdown(self, wait: bool = True):
+        with self.condition:
+            self.running = False
+            for queue in self.queues.values():
+                for future, *_ in queue:
+                    future.cancel()
+            self.queues.clear()
+            self.condition.notify_all()
+        if wait:
+            for thread in self.threads:
+                thread.join()
+        self.logger.info('Download pool is down')